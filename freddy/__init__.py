@@ -1,39 +1,49 @@
+import collections
+import copy
+import datetime
 import requests
+import threading
+import time
+import weakref
 from functools import partial
-from .util import PropertyDict, to_urlparam, to_json_string
-
-__all__ = ['Facility', 'Registry']
-
-
-# These functions encapsulate differences between JSON representations of a
-# facility for different provider implementations as we move towards a
-# finalized version of the API.
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from .columns import DEFAULT_FIELDS, to_columns
+from .control import RequestController
+from .dialects import get_dialect, _identity
+from .index import IdentifierIndex
+from .snapshot import Snapshot, write_snapshot
+from .spatial import SpatialIndex
+from .util import (PropertyDict, JSONArrayStream, SingleFlight,
+                   get_default_codec, parse_date, to_urlparam, to_http_date)
+
+__all__ = ['Facility', 'ReadOnlyFacility', 'Registry', 'AsyncRegistry',
+           'Session', 'Snapshot']
+
+
+# Differences between the JSON representations of a facility used by
+# different provider implementations are handled by the dialects in
+# freddy.dialects.  These are kept for code that calls them directly.
 def transform_incoming_data(data, url):
-    if 'resmap' in url:
-        data['uuid'] = data.pop('id')
-        data['href'] = data.pop('url')
-
-    return data
+    return _url_dialect(url).incoming(data)
 
 def transform_outgoing_data(data, url):
-    if 'resmap' in url:
-        if 'uuid' in data:
-            data['id'] = data.pop('uuid')
-        if 'href' in data:
-            data['url'] = data.pop('href')
+    return _url_dialect(url).outgoing(data)
+
+_url_dialects = {}
 
-        data.pop('createdAt', None)
-        data.pop('updatedAt', None)
-        data.pop('url', None)
-        data.pop('id', None)
-    
-    return data
+def _url_dialect(url):
+    # building a dialect costs more than converting one facility
+    try:
+        return _url_dialects[url]
+    except KeyError:
+        return _url_dialects.setdefault(url, get_dialect(url))
 
 
 class FredError(Exception):
     pass
 
-class FredHttpError(FredError):
+class FredHttpError(FredError, requests.HTTPError):
     pass
 
 class FredAuthenticationError(FredHttpError):
@@ -45,16 +55,73 @@ class RegistryAPI(object):
     Basic wrapper for the Facility Registry REST API.  Raises
     requests.HTTPError whenever a non-success HTTP status code is returned.
 
+    Requests go through a pool of persistent keep-alive connections that is
+    shared by every thread using this object.  Call close() (or use the
+    object as a context manager) to release the pooled connections.
+
     url -- base URL for an API endpoint, without the slash
     username, password -- credentials for HTTP Basic Authentication
+    pool_size -- maximum number of connections kept open to the server
+    gzip -- whether to ask the server for gzip-compressed responses
+    codec -- object used to encode and decode JSON, such as
+        freddy.util.JSONCodec.  Defaults to the fastest one installed.
+    dialect -- the provider's freddy.dialects.Dialect, as an instance,
+        subclass or name.  Detected from the url by default.
+    controller -- freddy.control.RequestController that retries failed
+        requests and limits concurrency.  Defaults to one that starts out
+        allowing pool_size requests at once.
 
     """
-    def __init__(self, url, username=None, password=None):
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url, username=None, password=None, pool_size=10,
+                 gzip=True, codec=None, dialect=None, controller=None):
         self.url = url
         self.auth = (username, password) if username else None
+        self.pool_size = pool_size
+        self.gzip = gzip
+        self.codec = codec or get_default_codec()
+        self.dialect = get_dialect(url, dialect)
+        self.controller = controller or RequestController(
+            max_concurrency=pool_size)
+
+        # requests.Session isn't guaranteed to be thread-safe, but the
+        # urllib3 connection pool inside an HTTPAdapter is, so each thread
+        # gets its own session mounted on the same shared adapter.
+        self._adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            session.auth = self.auth
+            session.headers['Accept-Encoding'] = (
+                'gzip, deflate' if self.gzip else 'identity')
+            self._local.session = session
+
+        return session
+
+    def close(self):
+        """Close all pooled connections."""
+
+        self._adapter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def request(self, method, path, **kwargs):
-        r = requests.request(method, self.url + path, auth=self.auth, **kwargs)
+        session = self.session
+        r = self.controller.send(
+            method, path,
+            lambda: session.request(method, self.url + path, **kwargs))
 
         try:
             r.raise_for_status()
@@ -85,37 +152,57 @@ class RegistryAPI(object):
         return r
 
     def get(self, id):
+        return self.get_if_modified(id)[0]
+
+    def get_if_modified(self, id, etag=None, updated_at=None):
+        """
+        Conditionally get a facility.  Returns a tuple of the facility data
+        and its ETag, where the data is None if the server reports that the
+        facility is unchanged since the version identified by `etag` or the
+        `updated_at` timestamp.
+
+        """
         if not id:
             raise TypeError("Tried to get a facility with a null id.")
 
-        r = self.request('GET', '/facilities/{id}.json'.format(id=id))
-        data = r.json()
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if updated_at:
+            headers['If-Modified-Since'] = to_http_date(updated_at)
+
+        r = self.request('GET', '/facilities/{id}.json'.format(id=id),
+                         headers=headers)
+        if r.status_code == 304:
+            return None, etag
 
-        return transform_incoming_data(data, self.url)
+        data = self.codec.loads(r.content)
+
+        return self.dialect.incoming(data), r.headers.get('ETag')
 
     def create(self, data):
-        data = transform_outgoing_data(data, self.url)
+        data = self.dialect.outgoing(data)
 
         r = self.request('POST', '/facilities.json',
-                         data=to_json_string(data),
+                         data=self.codec.dumps(data),
                          headers={'Content-Type': 'application/json'})
-        data = r.json()
+        data = self.codec.loads(r.content)
         if 'href' not in data:
             data['href'] = r.headers['Location']
 
-        return transform_incoming_data(data, self.url)
+        return self.dialect.incoming(data)
 
     def update(self, id, data):
-        data = transform_outgoing_data(data, self.url)
+        data = self.dialect.outgoing(data)
 
         if not id:
             raise TypeError("Tried to update a facility with a null id.")
 
         r = self.request('PUT', '/facilities/{id}.json'.format(id=id),
-                         data=to_json_string(data),
+                         data=self.codec.dumps(data),
                          headers={'Content-Type': 'application/json'})
 
-        return transform_incoming_data(r.json(), self.url)
+        return self.dialect.incoming(self.codec.loads(r.content))
 
     def delete(self, id):
         if not id:
@@ -128,11 +215,34 @@ class RegistryAPI(object):
         params = params or {}
 
         r = self.request('GET', '/facilities.json', params=params)
-        json = r.json()
-        json['facilities'] = [transform_incoming_data(f, self.url) for f in json['facilities']]
+        json = self.codec.loads(r.content)
+        json['facilities'] = self.dialect.incoming_page(json['facilities'])
 
         return json
 
+    def iter_list(self, params=None):
+        """
+        Like list(), but streams the response and yields each facility as
+        soon as it has been read instead of decoding the whole list first.
+
+        """
+        params = params or {}
+
+        r = self.request('GET', '/facilities.json', params=params, stream=True)
+        try:
+            chunks = r.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)
+            incoming = self.dialect.incoming
+            facilities = JSONArrayStream(chunks, 'facilities',
+                                         decoder=self.codec.raw_decoder)
+            if incoming is _identity:
+                for f in facilities:
+                    yield f
+            else:
+                for f in facilities:
+                    yield incoming(f)
+        finally:
+            r.close()
+
 
 class Registry(object):
     """
@@ -143,19 +253,127 @@ class Registry(object):
     url -- base API endpoint url, without trailing slash
     username, password -- HTTP Basic Authentication credentials
     facility_class -- an optional subclass of Facility to use for results
+    pool_size, gzip -- connection pool options passed to RegistryAPI
+    codec, dialect, controller -- JSON codec, provider dialect and request
+        controller passed to RegistryAPI
+    page_size -- number of facilities fetched per request when iterating over
+        facility lists, or None to fetch each list in a single request
+    partial_updates -- whether to send only the modified fields when saving
+        an existing facility.  This skips saving unmodified facilities and
+        allows saving facilities from partial responses.
+    cache -- an optional freddy.cache.FacilityCache used by get()
+    query_cache -- an optional freddy.cache.QueryCache used by facility
+        queries
+    fingerprints -- an optional freddy.fingerprint.FingerprintStore, used to
+        skip saving facilities whose content is the same as on the server
+    backend -- an optional local store such as freddy.mirror.LocalMirror to
+        run get() and facility queries against instead of the server.  Saves
+        and deletes are still sent to the server, then applied to the store.
+
+    Objects in the listeners attribute have their upsert() method called with
+    the data of each facility saved through the registry, and their delete()
+    method called with the uuid of each facility deleted.
 
     """
-    def __init__(self, url, username=None, password=None, facility_class=None):
-        self.api = RegistryAPI(url, username=username, password=password)
+    def __init__(self, url, username=None, password=None, facility_class=None,
+                 pool_size=10, gzip=True, page_size=500,
+                 partial_updates=False, cache=None, query_cache=None,
+                 fingerprints=None, backend=None, codec=None, dialect=None,
+                 controller=None):
+        self.api = RegistryAPI(url, username=username, password=password,
+                               pool_size=pool_size, gzip=gzip, codec=codec,
+                               dialect=dialect, controller=controller)
         self.Facility = partial(facility_class or Facility, registry=self)
+        self.page_size = page_size
+        self.partial_updates = partial_updates
+        self.cache = cache
+        self.query_cache = query_cache
+        self.fingerprints = fingerprints
+        self.backend = backend
+        self.listeners = []
+
+        self._in_flight = SingleFlight(copy_result=copy.deepcopy)
+        self._dirty = weakref.WeakSet()
+        self._dirty_lock = threading.Lock()
+
+    def close(self):
+        """Release the connections held by the underlying RegistryAPI."""
+
+        self.api.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def get(self, id):
-        """Get the facility with id `id` from the server."""
+        """
+        Get the facility with id `id` from the server or cache.  Concurrent
+        calls for the same id share a single request.
+
+        """
+        data = None
+        if self.backend is not None:
+            data = self.backend.get(id)
 
-        data = self.api.get(id)
+        if data is None:
+            data = self._fetch(id)
 
         return self.Facility(new=False, **data)
 
+    def get_many(self, ids, max_workers=10):
+        """
+        Get many facilities at once.  Facilities in the backend are looked up
+        in a single batch, and the rest are fetched from the server
+        concurrently.  Returns a tuple of the facilities found, in the order
+        of `ids`, and a list of the ids that don't exist.
+
+        max_workers -- maximum number of requests in flight at once
+
+        """
+        ids = list(ids)
+        unique = list(collections.OrderedDict.fromkeys(ids))
+
+        found = {}
+        if self.backend is not None:
+            found.update(self.backend.get_many(unique))
+
+        def fetch(id):
+            try:
+                return id, self._fetch(id)
+            except FredHttpError as e:
+                if e.response.status_code == 404:
+                    return id, None
+                raise
+
+        remaining = [id for id in unique if id not in found]
+        if remaining:
+            pool = ThreadPool(max(1, min(max_workers, len(remaining))))
+            try:
+                found.update(pool.imap_unordered(fetch, remaining))
+            finally:
+                pool.close()
+                pool.join()
+
+        facilities = []
+        missing = []
+        used = set()
+        for id in ids:
+            data = found[id]
+            if data is None:
+                missing.append(id)
+                continue
+
+            # repeated ids each get their own copy of the data
+            if id in used:
+                data = copy.deepcopy(data)
+            used.add(id)
+
+            facilities.append(self.Facility(new=False, **data))
+
+        return facilities, missing
+
     def create(self, prop_dict=None, **prop_kw):
         """Create a new Facility object without sending it to the server."""
 
@@ -163,35 +381,622 @@ class Registry(object):
         return self.Facility(**prop_kw)
 
     def save(self, facility):
-        """Save a facility to the server."""
+        """
+        Save a facility to the server.  With a FingerprintStore, a facility
+        whose content matches the last known server state isn't sent, and
+        its current data is returned.
+
+        """
+        if (self.fingerprints is not None and not facility._partial and
+                self.fingerprints.unchanged(facility)):
+            return facility.to_dict()
+
+        if self.is_partial_update(facility):
+            data = facility.get_changes()
+            required = [p for p in ('active', 'coordinates') if p in data]
+        else:
+            data = facility.to_dict()
+            required = ('active', 'coordinates')
 
-        if facility['active'] is None:
-            raise FredError("active must not be None.")
-        if facility['coordinates'] is None:
-            raise FredError("coordinates must not be None.")
+        for prop in required:
+            if facility[prop] is None:
+                raise FredError("{0} must not be None.".format(prop))
 
-        data = facility.to_dict()
-        uuid = data.get('uuid')
+        uuid = facility['uuid']
 
         if uuid:
-            return self.api.update(uuid, data)
+            # invalidate after writing, since a concurrent get() could cache
+            # the old data while the request is in flight
+            try:
+                data = self.api.update(uuid, data)
+            finally:
+                if self.cache is not None:
+                    self.cache.invalidate(uuid)
         else:
-            return self.api.create(data)
+            data = self.api.create(data)
+
+        for listener in self._listeners:
+            listener.upsert(data)
+
+        return data
 
     def delete(self, facility):
         """Delete `facility` from the server."""
 
-        self.api.delete(facility['uuid'])
+        try:
+            self.api.delete(facility['uuid'])
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(facility['uuid'])
+
+        for listener in self._listeners:
+            listener.delete(facility['uuid'])
+
+    def session(self, max_workers=10):
+        """
+        Returns a Session for batching changes to facilities, e.g.
+
+            with registry.session() as session:
+                facility = session.get(id)
+                facility['name'] = name
+
+        """
+        return Session(self, max_workers=max_workers)
+
+    def export_snapshot(self, path, query=None, compress=None):
+        """
+        Stream the facilities matched by `query` (by default, all
+        facilities) to a newline-delimited JSON file at `path`, one page at
+        a time.  Returns the number of facilities written.  Open the file
+        with freddy.Snapshot.
+
+        compress -- whether to gzip the file.  Defaults to whether `path`
+            ends in .gz.
+
+        """
+        if query is None:
+            query = self.facilities
+        # the caller's query is left as it was
+        query = copy.copy(query).raw()
+
+        page_size = query.page_size or FacilityQuery.DEFAULT_PAGE_SIZE
+
+        return write_snapshot(query.range(page_size=page_size), path,
+                              codec=self.api.codec, compress=compress)
+
+    def dirty(self):
+        """
+        Returns a list of the facilities created by or loaded from this
+        registry that have unsaved changes.  Facilities are only held weakly,
+        so ones that are no longer referenced elsewhere aren't included.
+
+        """
+        with self._dirty_lock:
+            return [f for f in self._dirty if f.is_modified]
+
+    def index_identifiers(self, query=None):
+        """
+        Returns an IdentifierIndex of the facilities matched by `query` (by
+        default, all facilities) that is kept up to date as facilities are
+        saved and deleted through this registry.
+
+        """
+        if query is None:
+            query = self.facilities.select('uuid', 'identifiers')
+
+        index = IdentifierIndex(query, registry=self)
+        self.listeners.append(index)
+
+        return index
+
+    def index_coordinates(self, query=None, cell_size=0.5):
+        """
+        Returns a SpatialIndex of the facilities matched by `query` (by
+        default, all facilities) that is kept up to date as facilities are
+        saved and deleted through this registry.
+
+        """
+        if query is None:
+            query = self.facilities.select('uuid', 'coordinates').readonly()
+
+        index = SpatialIndex(query, cell_size=cell_size, registry=self)
+        self.listeners.append(index)
+
+        return index
+
+    def is_partial_update(self, facility):
+        """Whether saving `facility` will only send its modified fields."""
+
+        return bool(self.partial_updates and facility['uuid'] and
+                    not facility._new)
+
+    def save_many(self, facilities, max_workers=10, progress=None):
+        """
+        Save many facilities concurrently, updating each one with the
+        server's response as Facility.save() does.  A failure to save one
+        facility doesn't stop the others from being saved.  Returns a
+        BatchResult.
+
+        max_workers -- maximum number of requests in flight at once
+        progress -- optional function called with the BatchResult each time
+            a facility has been processed
+
+        """
+        return self._run_many(lambda f: f.save(), facilities, max_workers,
+                              progress)
+
+    def delete_many(self, facilities, max_workers=10, progress=None):
+        """
+        Delete many facilities concurrently.  Arguments and return value are
+        the same as for save_many().
+
+        """
+        return self._run_many(lambda f: f.delete(), facilities, max_workers,
+                              progress)
+
+    def _run_many(self, method, facilities, max_workers, progress):
+        facilities = list(facilities)
+        result = BatchResult(len(facilities))
+
+        def attempt(facility):
+            # any error is recorded, so that one bad response can't stop
+            # the batch after other facilities have been written
+            try:
+                method(facility)
+            except Exception as e:
+                return facility, e
+            return facility, None
+
+        pool = ThreadPool(max(1, min(max_workers, len(facilities))))
+        try:
+            for facility, error in pool.imap_unordered(attempt, facilities):
+                if error is None:
+                    result.succeeded.append(facility)
+                else:
+                    result.failed.append((facility, error))
+
+                if progress:
+                    progress(result)
+        finally:
+            pool.close()
+            pool.join()
+
+        result.finished = time.time()
+
+        return result
 
     @property
     def facilities(self):
-        return FacilityQuery(self._query_function)
+        return FacilityQuery(self._query_function, page_size=self.page_size)
+
+    def _fetch(self, id):
+        """
+        Get facility data from the cache or server, sharing one request
+        between the threads that ask for the same id at the same time.
+        Fingerprints are only recorded from the server's responses, since a
+        cache entry may be out of date.
+
+        """
+        if self.cache is not None:
+            get = partial(self.cache.lookup, self.api, id)
+        else:
+            get = lambda: (self.api.get(id), True)
 
-    def _query_function(self, params, partial=False):
-        results = self.api.list(params=params)['facilities']
+        data, from_server = self._in_flight.do(id, get)[0]
+        if from_server and self.fingerprints is not None:
+            self.fingerprints.upsert(data)
 
+        return data
+
+    def _remember(self, results):
         for r in results:
-            yield self.Facility(partial=partial, **r)
+            self.fingerprints.upsert(r)
+            yield r
+
+    def _track(self, facility, dirty):
+        """Called by facilities when they're modified, saved or deleted."""
+
+        with self._dirty_lock:
+            if dirty:
+                self._dirty.add(facility)
+            else:
+                self._dirty.discard(facility)
+
+    @property
+    def _listeners(self):
+        return [store for store in (self.backend, self.query_cache,
+                                    self.fingerprints)
+                if store is not None] + self.listeners
+
+    def _query_function(self, params, partial=False, readonly=False,
+                        raw=False):
+        if self.backend is not None:
+            query = self.backend.query
+        elif self.fingerprints is not None and not partial:
+            # only remember what the server returns, not cached results
+            query = lambda params: self._remember(
+                self.api.iter_list(params=params))
+        else:
+            query = lambda params: self.api.iter_list(params=params)
+
+        if self.query_cache is not None:
+            results = self.query_cache.get(params, query)
+        else:
+            results = query(params)
+
+        if raw:
+            for r in results:
+                yield r
+        elif readonly:
+            for r in results:
+                yield ReadOnlyFacility(r, registry=self, partial=partial)
+        else:
+            for r in results:
+                yield self.Facility(new=False, partial=partial, **r)
+
+
+class BatchResult(object):
+    """
+    Outcome of a Registry.save_many() or delete_many() call.
+
+    total -- number of facilities in the batch
+    succeeded -- facilities that were processed successfully
+    failed -- (facility, exception) tuples for those that weren't.  For HTTP
+        errors the exception has the usual response and fred_error_info
+        attributes.
+
+    """
+    def __init__(self, total):
+        self.total = total
+        self.succeeded = []
+        self.failed = []
+
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def completed(self):
+        return len(self.succeeded) + len(self.failed)
+
+    @property
+    def elapsed(self):
+        """Seconds taken so far, or in total once the batch has finished."""
+
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """Facilities processed per second."""
+
+        elapsed = self.elapsed
+        return self.completed / elapsed if elapsed else 0.0
+
+    def __repr__(self):
+        return "<BatchResult {0}/{1} done, {2} failed, {3:.1f}/s>".format(
+            self.completed, self.total, len(self.failed), self.rate)
+
+
+class AsyncRegistry(object):
+    """
+    Non-blocking interface to a Registry.  Each call is run on a pool of
+    worker threads sharing the registry's connection pool, and immediately
+    returns a multiprocessing.pool.AsyncResult whose get() method waits for
+    the result or re-raises the error.  Each method also takes an optional
+    callback that is called with the result from a worker thread.
+
+    registry -- the Registry to wrap
+    concurrency -- maximum number of requests in flight at once
+
+    """
+    def __init__(self, registry, concurrency=10):
+        self.registry = registry
+        self.concurrency = concurrency
+        self._pool = ThreadPool(concurrency)
+
+    def get(self, id, callback=None):
+        """Get the facility with id `id` from the server."""
+
+        return self._pool.apply_async(
+            self.registry.get, (id,), callback=callback)
+
+    def create(self, prop_dict=None, **prop_kw):
+        """Create a new Facility object without sending it to the server."""
+
+        return self.registry.create(prop_dict, **prop_kw)
+
+    def save(self, facility, callback=None):
+        """Save `facility`, updating it with the server's response."""
+
+        return self._pool.apply_async(
+            self._call, (facility.save, facility), callback=callback)
+
+    def delete(self, facility, callback=None):
+        """Delete `facility` from the server."""
+
+        return self._pool.apply_async(
+            self._call, (facility.delete, facility), callback=callback)
+
+    def list(self, query, callback=None, page_callback=None):
+        """
+        Execute a FacilityQuery, resulting in a list of facilities.
+
+        page_callback -- if given, each page of facilities is instead passed
+            to this function from a worker thread as soon as it has been
+            read, so that only one page is held in memory, and the result is
+            the number of facilities
+
+        """
+        if page_callback is None:
+            return self._pool.apply_async(list, (query,), callback=callback)
+
+        return self._pool.apply_async(
+            self._list_pages, (query, page_callback), callback=callback)
+
+    @property
+    def facilities(self):
+        return self.registry.facilities
+
+    def close(self):
+        """Wait for outstanding requests, then stop the worker threads."""
+
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _call(method, facility):
+        method()
+        return facility
+
+    @staticmethod
+    def _list_pages(query, page_callback):
+        page_size = query.page_size or FacilityQuery.DEFAULT_PAGE_SIZE
+
+        count = 0
+        page = []
+        for facility in query.range(page_size=page_size):
+            page.append(facility)
+            if len(page) == page_size:
+                page_callback(page)
+                count += len(page)
+                page = []
+
+        if page:
+            page_callback(page)
+            count += len(page)
+
+        return count
+
+
+class Session(object):
+    """
+    Unit of work for a Registry.  Facilities loaded or created through the
+    session are tracked, and each facility is loaded only once: getting or
+    listing it again returns the same object.  save() and delete(), and
+    the same methods of the facilities the session hands out, only record
+    what to do, and commit() then writes the new, saved and modified
+    facilities concurrently, followed by the deletions.  However many times
+    a facility is changed or saved, only its final state is written.
+    Facilities that were loaded but not passed to save() are only written
+    if their content differs from when they were loaded, including changes
+    made in place to lists such as identifiers.
+
+    Used as a context manager, the session commits when the block exits
+    without an exception and discards its changes otherwise.
+
+    registry -- the Registry to load from and write to
+    max_workers -- maximum number of requests in flight during a commit
+
+    """
+    def __init__(self, registry, max_workers=10):
+        self.registry = registry
+        self.max_workers = max_workers
+        self.result = None
+
+        self._facilities = collections.OrderedDict()
+        self._new = []
+        self._saved = set()
+        self._deleted = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, id):
+        """Get the facility with id `id`, loading it if it isn't tracked."""
+
+        with self._lock:
+            facility = self._facilities.get(id)
+        if facility is not None:
+            return facility
+
+        return self.add(self.registry.get(id))
+
+    def create(self, prop_dict=None, **prop_kw):
+        """Create a new facility that will be saved on commit."""
+
+        return self.add(self.registry.create(prop_dict, **prop_kw))
+
+    def add(self, facility):
+        """
+        Track `facility`, returning the tracked facility with its uuid if
+        there already is one.
+
+        """
+        uuid = facility['uuid']
+
+        with self._lock:
+            self._adopt_saved()
+            if not uuid:
+                if facility not in self._new:
+                    self._new.append(facility)
+            else:
+                facility = self._facilities.setdefault(uuid, facility)
+
+        facility.session = self
+        facility._watch_lists()
+        return facility
+
+    def save(self, facility):
+        """
+        Save `facility` on commit.  If the session tracks a different object
+        with the same uuid, `facility` replaces it, so that it's the one
+        written.
+
+        """
+        uuid = facility['uuid']
+
+        with self._lock:
+            self._adopt_saved()
+            if not uuid:
+                if facility not in self._new:
+                    self._new.append(facility)
+            else:
+                self._facilities[uuid] = facility
+                self._saved.add(uuid)
+
+        facility.session = self
+        return facility
+
+    def delete(self, facility):
+        """Delete `facility` on commit, instead of saving it."""
+
+        facility = self.add(facility)
+
+        with self._lock:
+            if facility['uuid']:
+                self._deleted[facility['uuid']] = facility
+            else:
+                self._new.remove(facility)
+                facility.session = None
+
+    @property
+    def facilities(self):
+        """A FacilityQuery whose results are tracked by the session."""
+
+        return FacilityQuery(self._query_function,
+                             page_size=self.registry.page_size)
+
+    @property
+    def pending(self):
+        """
+        Returns a tuple of the facilities that commit() would save and the
+        ones it would delete.
+
+        """
+        with self._lock:
+            self._adopt_saved()
+            upserts = [f for f in self._new + list(self._facilities.values())
+                       if f['uuid'] not in self._deleted and
+                       (f['uuid'] in self._saved or f.is_modified or
+                        f.get_changes())]
+            return upserts, list(self._deleted.values())
+
+    def commit(self):
+        """
+        Write all pending changes.  Returns a SessionResult.  Facilities that
+        fail to save or delete stay pending, so the commit can be retried.
+
+        """
+        upserts, deletes = self.pending
+        with self._lock:
+            unchanged = (len(self._new) + len(self._facilities) -
+                         len(upserts) - len(deletes))
+
+        # the facilities' own save() and delete() do the writing, so they
+        # mustn't defer to the session while they're being committed
+        self._bind(upserts + deletes, None)
+        try:
+            saved = self.registry.save_many(upserts,
+                                            max_workers=self.max_workers)
+
+            with self._lock:
+                self._adopt_saved()
+                self._saved.difference_update(
+                    f['uuid'] for f in saved.succeeded)
+
+            deleted = self.registry.delete_many(deletes,
+                                                max_workers=self.max_workers)
+
+            with self._lock:
+                for facility in deleted.succeeded:
+                    del self._deleted[facility['uuid']]
+                    del self._facilities[facility['uuid']]
+                    self._saved.discard(facility['uuid'])
+        finally:
+            with self._lock:
+                tracked = set(self._new) | set(self._facilities.values())
+            self._bind([f for f in upserts + deletes if f in tracked], self)
+
+        self.result = SessionResult(saved, deleted, unchanged)
+
+        return self.result
+
+    def rollback(self):
+        """Stop tracking all facilities and forget the pending deletions."""
+
+        with self._lock:
+            self._bind(self._new + list(self._facilities.values()), None)
+            self._facilities.clear()
+            del self._new[:]
+            self._saved.clear()
+            self._deleted.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    @staticmethod
+    def _bind(facilities, session):
+        for facility in facilities:
+            facility.session = session
+
+    def _adopt_saved(self):
+        # new facilities get a uuid once they've been saved
+        for facility in [f for f in self._new if f['uuid']]:
+            self._new.remove(facility)
+            self._facilities.setdefault(facility['uuid'], facility)
+
+    def _query_function(self, params, partial=False, readonly=False,
+                        raw=False):
+        results = self.registry._query_function(params, partial=partial,
+                                                readonly=readonly, raw=raw)
+        if readonly or raw:
+            return results
+
+        return (self.add(facility) for facility in results)
+
+
+class SessionResult(object):
+    """
+    Outcome of a Session.commit().
+
+    saved -- BatchResult of saving the new and modified facilities
+    deleted -- BatchResult of deleting facilities
+    unchanged -- number of tracked facilities that didn't need writing
+
+    """
+    def __init__(self, saved, deleted, unchanged):
+        self.saved = saved
+        self.deleted = deleted
+        self.unchanged = unchanged
+
+    @property
+    def failed(self):
+        return self.saved.failed + self.deleted.failed
+
+    def __repr__(self):
+        return ("<SessionResult {0} saved, {1} deleted, {2} unchanged, "
+                "{3} failed>".format(len(self.saved.succeeded),
+                                     len(self.deleted.succeeded),
+                                     self.unchanged, len(self.failed)))
 
 
 class Facility(object):
@@ -216,15 +1021,27 @@ class Facility(object):
 
     EXTENDED_DATE_PROPERTIES = ()
 
+    _snapshot = None
+
+    # the Session tracking this facility, which save() and delete() leave
+    # the writing to
+    session = None
+
     def __init__(self, registry=None, new=True, partial=False, **kwargs):
         self.registry = registry
         self._new = new
         self._partial = partial
         self._deleted = False
         
-        self.data = self._get_property_dict(**kwargs)
-        
+        self._load(kwargs)
+
+        if new and registry is not None:
+            registry._track(self, True)
+
     def delete(self):
+        if self.session is not None:
+            self.session.delete(self)
+            return
         if not self['uuid']:
             raise FredError("Tried to delete an unsaved facility.")
         if self._deleted:
@@ -232,17 +1049,26 @@ class Facility(object):
 
         self.registry.delete(self)
         self._deleted = True
+        self.registry._track(self, False)
 
     def save(self):
         if self._deleted:
             raise FredError("Tried to save a deleted facility.")
-        # remove once partial updates is implemented
-        if self._partial:
+        if self.session is not None:
+            self.session.save(self)
+            return
+
+        if self.registry.is_partial_update(self):
+            if not self.get_changes():
+                self.registry._track(self, False)
+                return
+        elif self._partial:
             raise FredError("Tried to save a partial response facility.")
 
         data = self.registry.save(self)
-        self.data = self._get_property_dict(**data)
         self._new = False
+        self._load(data)
+        self.registry._track(self, False)
 
     @property
     def is_touched(self):
@@ -255,6 +1081,31 @@ class Facility(object):
     def to_dict(self):
         return dict(self.__iter__())
 
+    def get_changes(self):
+        """
+        Returns a dict of the properties that have been modified since the
+        facility was loaded or last saved.  With partial updates, or once
+        it's tracked by a Session, this includes lists such as identifiers
+        that were changed in place.  If any extended property
+        was modified, all of them are included under 'properties', since
+        the API replaces the whole properties object on update.
+
+        """
+        changes, deleted = self.data.get_changes()
+        changes.update((k, None) for k in deleted)
+
+        lists, property_lists = self._snapshot or ({}, {})
+        for k, val in lists.items():
+            if k not in changes and self.data.get(k) != val:
+                changes[k] = self.data.get(k)
+
+        properties = self['properties']
+        if properties.is_modified or any(
+                properties.get(k) != val for k, val in property_lists.items()):
+            changes['properties'] = dict(properties.items())
+
+        return changes
+
     def __iter__(self):
         for prop, val in self.data.items():
             if val is not None:
@@ -281,6 +1132,38 @@ class Facility(object):
                 if ((agency == id['agency'] or agency is None) and
                     (context == id['context'] or context is None))]
 
+    def _load(self, data):
+        self.data = self._get_property_dict(**data)
+        self.data.on_change = self._data_changed
+
+        # keep watching for changes made in place after a save
+        if self._snapshot is not None or (
+                self.registry is not None and self.registry.partial_updates):
+            self._snapshot = None
+            self._watch_lists()
+
+    def _watch_lists(self):
+        """
+        Lists and dicts can be changed in place without the PropertyDicts
+        noticing, so keep copies of them for get_changes() to compare with.
+        Only done when it's needed, since copying them is the most expensive
+        part of creating a Facility.
+
+        """
+        if self._new or self._snapshot is not None:
+            return
+
+        self._snapshot = (
+            dict((k, copy.deepcopy(v)) for k, v in dict.items(self.data)
+                 if isinstance(v, list)),
+            dict((k, copy.deepcopy(v))
+                 for k, v in dict.items(self['properties'])
+                 if isinstance(v, (list, dict))))
+
+    def _data_changed(self, data):
+        if self.registry is not None:
+            self.registry._track(self, self.is_modified)
+
     def _get_property_dict(self, uuid=None, name=None, href=None,
                            identifiers=None, coordinates=None, active=True,
                            createdAt=None, updatedAt=None, properties=None):
@@ -301,6 +1184,99 @@ class Facility(object):
         }, date_properties=self.DATE_PROPERTIES)
 
 
+class ReadOnlyFacility(object):
+    """
+    Compact read-only view of facility data from a list query, which avoids
+    the cost of building a change-tracking Facility for every result.  Dates
+    are only parsed when they're accessed.  Call edit() to get a Facility
+    that can be modified and saved.
+
+    data -- facility data as returned by RegistryAPI
+    registry -- the Registry the data came from
+    partial -- whether this is data from a partial response
+
+    """
+    __slots__ = ('_data', 'registry', '_partial')
+
+    DEFAULTS = {
+        'identifiers': (),
+        'active': True
+    }
+
+    def __init__(self, data, registry=None, partial=False):
+        self._data = data
+        self.registry = registry
+        self._partial = partial
+
+    @property
+    def facility_class(self):
+        if self.registry is not None:
+            return self.registry.Facility.func
+        return Facility
+
+    def edit(self):
+        """Returns a Facility with this data that can be modified and saved."""
+
+        factory = (self.registry.Facility if self.registry is not None
+                   else Facility)
+        # the Facility mustn't share identifiers, coordinates or properties
+        # with this object
+        return factory(new=False, partial=self._partial,
+                       **copy.deepcopy(self._data))
+
+    is_touched = False
+    is_modified = False
+
+    def to_dict(self):
+        return dict(self.__iter__())
+
+    def __iter__(self):
+        for prop in list(self._data):
+            val = self[prop]
+            if val is not None:
+                yield (prop, val)
+
+    def __getitem__(self, name):
+        try:
+            val = self._data[name]
+        except KeyError:
+            if name == 'properties':
+                return {}
+            return self.DEFAULTS.get(name)
+
+        facility_class = self.facility_class
+        if name in facility_class.DATE_PROPERTIES:
+            val = self._data[name] = self._parse_date(val)
+        elif name == 'properties' and val:
+            dates = [prop for prop in facility_class.EXTENDED_DATE_PROPERTIES
+                     if not isinstance(val.get(prop), (datetime.datetime,
+                                                       type(None)))]
+            if dates:
+                # parsed into a copy, in case the dict was already handed out
+                val = self._data[name] = dict(val, **dict(
+                    (prop, self._parse_date(val[prop])) for prop in dates))
+
+        return val
+
+    def __setitem__(self, name, val):
+        raise FredError("Tried to modify a read-only facility; use edit().")
+
+    def get_identifiers(self, agency=None, context=None):
+        """
+        Returns a list of identifiers matching agency and context.
+
+        """
+        return [id for id in self['identifiers']
+                if ((agency == id['agency'] or agency is None) and
+                    (context == id['context'] or context is None))]
+
+    @staticmethod
+    def _parse_date(val):
+        if val is not None and not isinstance(val, datetime.datetime):
+            return parse_date(val)
+        return val
+
+
 class FacilityQuery(object):
     """
     Fluent API for constructing a facility query, including sorting, filtering,
@@ -308,16 +1284,24 @@ class FacilityQuery(object):
 
     query_function -- a function that takes a dict of url parameters and
         and returns an iterable of Facility objects
+    page_size -- default number of facilities to request at a time when
+        iterating, or None to fetch the whole result set in one request
 
     """
-    def __init__(self, query_function):
+    DEFAULT_PAGE_SIZE = 500
+
+    def __init__(self, query_function, page_size=None):
         self.query_function = query_function
+        self.page_size = page_size
 
         self.filter_dict = {}
         self.sort_asc_prop_name = None
         self.sort_desc_prop_name = None
         self.sort_clauses = ()
         self.select_properties = ()
+        self.readonly_results = False
+        self.raw_results = False
+        self.prefetch_pages = None
 
         self._executed = False
 
@@ -345,7 +1329,7 @@ class FacilityQuery(object):
         if self.is_sorted:
             raise FredError()
 
-        self.sort_desc_prop = prop
+        self.sort_desc_prop_name = prop
 
         return self
 
@@ -353,25 +1337,144 @@ class FacilityQuery(object):
         self.select_properties = tuple(properties)
         return self
 
+    def readonly(self):
+        """Return ReadOnlyFacility objects instead of Facility objects."""
+
+        self.readonly_results = True
+        return self
+
+    def raw(self):
+        """Return facility data dicts instead of Facility objects."""
+
+        self.raw_results = True
+        return self
+
+    def prefetch(self, pages=4):
+        """
+        When iterating page by page, request up to `pages` pages at once on
+        background threads instead of waiting for each page to be consumed
+        before requesting the next.  Facilities are still returned in order,
+        and at most `pages` pages are held in memory ahead of the consumer.
+
+        """
+        self.prefetch_pages = pages
+        return self
+
+    def to_columns(self, fields=DEFAULT_FIELDS, use_numpy=None, **kwargs):
+        """
+        Execute the query and collect the results into one array per field
+        (NumPy arrays if available), without creating a Facility for each
+        result.  See freddy.columns.to_columns().  Extra keyword arguments
+        are passed to range().
+
+        """
+        if not self.select_properties:
+            props = [f.split('.')[0] for f in fields]
+            self.select(*sorted(set(props), key=props.index))
+
+        return to_columns(self.raw().range(**kwargs), fields,
+                          use_numpy=use_numpy)
+
     def range(self, start=None, end=None, page_size=None):
+        """
+        Execute the query and return an iterator over the facilities from
+        offset `start` up to (but not including) `end`.
+
+        page_size -- if set, facilities are fetched lazily with one request
+            for every `page_size` results instead of all at once.  Defaults
+            to the page size the query was created with.
+
+        """
         if self._executed:
             raise FredError("Tried to re-execute an executed query.")
 
         start = start or 0
-        page_size = page_size or (end - start if end else 'off')
+        page_size = page_size or self.page_size
 
+        self._executed = True
+
+        if not page_size:
+            return self._query_page(start, end - start if end else 'off')
+        elif self.prefetch_pages and self.prefetch_pages > 1:
+            return self._iter_pages_prefetched(start, end, page_size,
+                                               self.prefetch_pages)
+
+        return self._iter_pages(start, end, page_size)
+
+    def iter_pages(self, page_size=DEFAULT_PAGE_SIZE, **kwargs):
+        """
+        Execute the query, requesting `page_size` facilities at a time as the
+        returned iterator is consumed.
+
+        """
+        return self.range(page_size=page_size, **kwargs)
+
+    def all(self, **kwargs):
+        return self.range(**kwargs)
+
+    def _query_page(self, offset, limit):
         params = self.params
         params.update({
-            'offset': start,
-            'limit': page_size
+            'offset': offset,
+            'limit': limit
         })
 
-        self._executed = True
+        kwargs = {'partial': self.select_properties}
+        if self.readonly_results:
+            kwargs['readonly'] = True
+        if self.raw_results:
+            kwargs['raw'] = True
 
-        return self.query_function(params, partial=self.select_properties)
+        return self.query_function(params, **kwargs)
 
-    def all(self, **kwargs):
-        return self.range(**kwargs)
+    def _iter_pages(self, start, end, page_size):
+        offset = start
+        while end is None or offset < end:
+            limit = page_size if end is None else min(page_size, end - offset)
+
+            count = 0
+            for facility in self._query_page(offset, limit):
+                count += 1
+                yield facility
+
+            # a short page means we've reached the end of the result set
+            if count < limit:
+                return
+
+            offset += count
+
+    def _iter_pages_prefetched(self, start, end, page_size, pages):
+        pool = ThreadPool(pages)
+        pending = collections.deque()
+        offset = start
+
+        def fetch(offset, limit):
+            return list(self._query_page(offset, limit))
+
+        try:
+            while True:
+                # keep `pages` requests in flight.  The total isn't known,
+                # so pages past the end may be requested and discarded.
+                while len(pending) < pages and (end is None or offset < end):
+                    limit = (page_size if end is None
+                             else min(page_size, end - offset))
+                    pending.append(
+                        (limit, pool.apply_async(fetch, (offset, limit))))
+                    offset += limit
+
+                if not pending:
+                    return
+
+                limit, result = pending.popleft()
+                page = result.get()
+                for facility in page:
+                    yield facility
+
+                # a short page means we've reached the end of the result set
+                if len(page) < limit:
+                    return
+        finally:
+            pool.terminate()
 
     def __iter__(self):
         return self.all()
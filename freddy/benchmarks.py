@@ -0,0 +1,146 @@
+"""
+Micro-benchmarks for freddy's hot paths.  Run with
+
+    python -m freddy.benchmarks
+
+Each benchmark prints the best time per call out of several repeats.
+
+"""
+import copy
+import dateutil.parser
+import json
+import timeit
+import freddy
+from freddy import util
+from freddy.dialects import ResourceMapDialect
+from freddy.util import JSONArrayStream, parse_date
+
+
+FACILITY = {
+    'uuid': u'b1c9eff6-92e0-465b-8e33-71012171eeb2',
+    'name': u'Panderu MCHP',
+    'href': u'http://example.com/facilities/b1c9eff6.json',
+    'createdAt': u'2012-02-17T14:54:39.987+0000',
+    'updatedAt': u'2013-03-21T18:09:52.000+0000',
+    'identifiers': [
+        {'agency': u'DHIS2', 'context': u'DHIS2_CODE', 'id': u'OU_222702'},
+        {'agency': u'DHIS2', 'context': u'DHIS2_UID', 'id': u'ueuQlqb8ccl'}
+    ],
+    'coordinates': [-11.5, 8.2],
+    'active': True,
+    'properties': {'beds': 12, 'type': u'MCHP'}
+}
+
+
+def codecs():
+    available = [util.JSONCodec()]
+    if util.simplejson is not None:
+        available.append(util.SimpleJSONCodec())
+    if util.ujson is not None:
+        available.append(util.UJSONCodec())
+
+    return available
+
+
+def run(name, func, number=2000, repeat=3):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    print('{0:<55} {1:10.2f} us'.format(name, best / number * 1e6))
+
+
+def date_parsing():
+    date = FACILITY['updatedAt']
+
+    run('dateutil.parser.parse', lambda: dateutil.parser.parse(date))
+    run('freddy.util.parse_date', lambda: parse_date(date))
+
+
+def facility_construction():
+    def eager_dateutil():
+        # what Facility construction used to cost: both timestamps parsed
+        # up front with dateutil
+        facility = freddy.Facility(new=False, **FACILITY)
+        dateutil.parser.parse(FACILITY['createdAt'])
+        dateutil.parser.parse(FACILITY['updatedAt'])
+        return facility
+
+    def lazy_dates_read():
+        facility = freddy.Facility(new=False, **FACILITY)
+        return facility['createdAt'], facility['updatedAt']
+
+    run('Facility, dates parsed eagerly with dateutil (before)',
+        eager_dateutil)
+    run('Facility, dates not read', lambda: freddy.Facility(new=False,
+                                                          **FACILITY))
+    run('Facility, dates read', lazy_dates_read)
+    run('ReadOnlyFacility, name read',
+        lambda: freddy.ReadOnlyFacility(copy.copy(FACILITY))['name'])
+
+
+def bulk_create_encoding():
+    facilities = [freddy.Facility(**FACILITY).to_dict() for i in range(500)]
+
+    def to_json_prepass():
+        # how request bodies used to be encoded
+        return [json.dumps(dict((k, util.to_json(v)) for k, v in f.items()))
+                for f in facilities]
+
+    codec = util.JSONCodec()
+
+    run('500 facilities, to_json pre-pass + json (before)', to_json_prepass,
+        number=20)
+    run('500 facilities, JSONCodec',
+        lambda: [codec.dumps(f) for f in facilities], number=20)
+
+
+def list_decoding():
+    page = json.dumps({'facilities': [FACILITY] * 500})
+
+    for codec in codecs():
+        name = codec.__class__.__name__
+        run('500-facility page, {0}.loads'.format(name),
+            lambda: codec.loads(page), number=20)
+        run('500-facility page, streamed with {0}'.format(name),
+            lambda: list(JSONArrayStream([page], 'facilities',
+                                         decoder=codec.raw_decoder)),
+            number=20)
+
+
+def dialect_conversion():
+    url = 'http://resmap.example.com/fred_api/v1'
+    resmap = dict(FACILITY, id=FACILITY['uuid'], url=FACILITY['href'])
+    del resmap['uuid'], resmap['href']
+
+    def url_sniffing():
+        # how list pages used to be converted
+        page = [dict(resmap) for i in range(500)]
+        for data in page:
+            if 'resmap' in url:
+                data['uuid'] = data.pop('id')
+                data['href'] = data.pop('url')
+        return page
+
+    dialect = ResourceMapDialect()
+
+    run('500-facility Resource Map page, copying only (baseline)',
+        lambda: [dict(resmap) for i in range(500)], number=200)
+    run('500-facility Resource Map page, url sniffing (before)',
+        url_sniffing, number=200)
+    run('500-facility Resource Map page, ResourceMapDialect',
+        lambda: dialect.incoming_page([dict(resmap) for i in range(500)]),
+        number=200)
+
+
+BENCHMARKS = [
+    date_parsing,
+    facility_construction,
+    bulk_create_encoding,
+    list_decoding,
+    dialect_conversion
+]
+
+
+if __name__ == '__main__':
+    for benchmark in BENCHMARKS:
+        print(benchmark.__name__)
+        benchmark()
+        print('')
@@ -0,0 +1,440 @@
+import collections
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+
+__all__ = ['FacilityCache', 'QueryCache', 'MemoryCache', 'DiskCache']
+
+
+class MemoryCache(object):
+    """
+    Thread-safe in-memory cache backend that evicts the least recently used
+    entries once it holds more than max_size of them.
+
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(object):
+    """
+    Cache backend storing each entry as a JSON file in a directory, so that
+    it can be shared between processes and survives restarts.  Once there
+    are more than max_size entries, the least recently used are evicted.
+
+    path -- directory to store entries in; created if it doesn't exist
+    max_size -- maximum number of entries, or None for no limit
+
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return entry
+
+    def set(self, key, entry):
+        filename = self._filename(key)
+        tmp_filename = '{0}.{1}.tmp'.format(
+            filename, threading.current_thread().ident)
+
+        with open(tmp_filename, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_filename, filename)
+
+        if self.max_size is not None:
+            self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for filename in self._filenames():
+            self._remove(filename)
+
+    def __len__(self):
+        return len(self._filenames())
+
+    def _evict(self):
+        with self._lock:
+            filenames = self._filenames()
+            if len(filenames) <= self.max_size:
+                return
+
+            filenames.sort(key=self._mtime)
+            for filename in filenames[:len(filenames) - self.max_size]:
+                self._remove(filename)
+
+    def _filename(self, key):
+        return os.path.join(
+            self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _filenames(self):
+        return [os.path.join(self.path, name) for name in os.listdir(self.path)
+                if name.endswith('.json')]
+
+    @staticmethod
+    def _mtime(filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+class FacilityCache(object):
+    """
+    Cache of facility data keyed by uuid, used by Registry.get().
+
+    Entries younger than ttl seconds are returned without contacting the
+    server.  Older entries are revalidated with a conditional GET using the
+    stored ETag and updatedAt timestamp, so that an unchanged facility costs
+    a 304 response instead of a full download.  Registry.save() and delete()
+    invalidate the entries for the facilities they touch, and data fetched
+    before an invalidation isn't stored afterwards.
+
+    backend -- a MemoryCache (the default), DiskCache or any object with the
+        same get/set/delete/clear methods
+    ttl -- seconds an entry is used without revalidation
+
+    """
+    def __init__(self, backend=None, ttl=60):
+        self.backend = backend if backend is not None else MemoryCache()
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._lock = threading.Lock()
+
+        # bumped by invalidate() and clear(), so that a fetch that started
+        # before them can tell not to store what it got
+        self._generations = {}
+        self._clears = 0
+        self._generation_lock = threading.Lock()
+
+    def get(self, api, id):
+        """Return the data for facility `id`, fetching it using `api`."""
+
+        return self.lookup(api, id)[0]
+
+    def lookup(self, api, id):
+        """
+        Like get(), but returns a tuple of the data and whether it came from
+        the server, either in full or confirmed by a 304 response, rather
+        than from an entry that's still fresh.
+
+        """
+        with self._generation_lock:
+            generation = self._generation(id)
+
+        entry = self.backend.get(id)
+
+        if entry is None:
+            self._count('misses')
+            data, etag = api.get_if_modified(id)
+        elif time.time() - entry['stored'] < self.ttl:
+            self._count('hits')
+            return copy.deepcopy(entry['data']), False
+        else:
+            self._count('revalidations')
+            data, etag = api.get_if_modified(
+                id, etag=entry['etag'],
+                updated_at=entry['data'].get('updatedAt'))
+
+            if data is None:
+                data, etag = entry['data'], entry['etag']
+
+        with self._generation_lock:
+            if self._generation(id) == generation:
+                self.backend.set(id, {
+                    'data': data,
+                    'etag': etag,
+                    'stored': time.time()
+                })
+
+        return copy.deepcopy(data), True
+
+    def invalidate(self, id):
+        with self._generation_lock:
+            self._generations[id] = self._generations.get(id, 0) + 1
+            self.backend.delete(id)
+
+    def clear(self):
+        with self._generation_lock:
+            self._clears += 1
+            self._generations.clear()
+            self.backend.clear()
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations
+        }
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _generation(self, id):
+        # called with _generation_lock held
+        return self._clears, self._generations.get(id, 0)
+
+
+class QueryCache(object):
+    """
+    In-memory cache of facility list results keyed by query parameters,
+    including the offset and limit, used by Registry facility queries.
+
+    Entries are used for ttl seconds.  Once the cache holds more than
+    max_size queries or max_facilities facilities in total, the least
+    recently used entries are evicted, and results with more than
+    max_facilities facilities aren't cached at all.
+
+    When a facility is saved or deleted through the registry, every cached
+    page of any query that included the facility, or whose filters the saved
+    facility matches, is dropped.  Since the previous version of a saved
+    facility isn't known, a query whose only cached pages come after the one
+    the facility used to be on may be stale until its entries expire.
+    Results fetched while any facility is saved or deleted aren't cached,
+    since they may be from before the change.
+
+    max_size -- maximum number of cached queries
+    max_facilities -- maximum number of facilities held, or None for no
+        limit
+    ttl -- seconds an entry is used for
+
+    """
+    # parameters that don't filter which facilities are listed
+    NON_FILTER_PARAMS = ('fields', 'allProperties', 'sortAsc', 'sortDesc',
+                         'offset', 'limit')
+
+    TOP_LEVEL_FILTERS = ('uuid', 'name', 'href')
+
+    def __init__(self, max_size=100, max_facilities=100000, ttl=60):
+        self.max_size = max_size
+        self.max_facilities = max_facilities
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._entries = collections.OrderedDict()
+        self._facility_count = 0
+        self._lock = threading.Lock()
+
+        # bumped by every invalidation and clear(), so that results fetched
+        # before them aren't stored afterwards
+        self._generation = 0
+
+    def get(self, params, query):
+        """
+        Return an iterable of the results of the query with url parameters
+        `params`, calling `query` with them to fetch the results on a miss.
+        Fetched results are passed through as they're read, and only cached
+        once they've all been read.
+
+        """
+        key = json.dumps(params, sort_keys=True)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and time.time() - entry['stored'] < self.ttl:
+                self._entries[key] = entry
+                self.hits += 1
+                return copy.deepcopy(entry['results'])
+            elif entry is not None:
+                self._facility_count -= len(entry['results'])
+
+            self.misses += 1
+            generation = self._generation
+
+        return self._stream(key, params, query(params), generation)
+
+    def upsert(self, data):
+        """Drop the queries `data`, a saved facility, could be listed by."""
+
+        self._invalidate(
+            lambda entry: (self._contains(entry, data['uuid']) or
+                           self._could_match(entry['params'], data)))
+
+    def delete(self, uuid):
+        """Drop the queries that listed the deleted facility `uuid`."""
+
+        self._invalidate(lambda entry: self._contains(entry, uuid))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._facility_count = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'queries': len(self._entries),
+            'facilities': self._facility_count
+        }
+
+    def _stream(self, key, params, results, generation):
+        # copies are only kept while there are few enough results to cache
+        kept = []
+        for r in results:
+            if kept is not None:
+                if (self.max_facilities is not None and
+                        len(kept) >= self.max_facilities):
+                    kept = None
+                else:
+                    kept.append(copy.deepcopy(r))
+
+            yield r
+
+        if kept is not None:
+            self._set(key, params, kept, generation)
+
+    def _set(self, key, params, results, generation):
+        uuids = [r.get('uuid') for r in results]
+
+        entry = {
+            'params': params,
+            'results': results,
+            # None if the fields selected didn't include the uuid
+            'uuids': frozenset(uuids) if None not in uuids else None,
+            'stored': time.time()
+        }
+
+        with self._lock:
+            if self._generation != generation:
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._facility_count -= len(old['results'])
+
+            self._entries[key] = entry
+            self._facility_count += len(results)
+
+            while self._entries and (
+                    len(self._entries) > self.max_size or
+                    (self.max_facilities is not None and
+                     self._facility_count > self.max_facilities)):
+                _, evicted = self._entries.popitem(last=False)
+                self._facility_count -= len(evicted['results'])
+
+    def _invalidate(self, affects):
+        with self._lock:
+            self._generation += 1
+
+            # a change to one page of a query can shift the facilities on
+            # its other pages, so drop every page of an affected query
+            stale = set(self._query_key(entry['params'])
+                        for entry in self._entries.values() if affects(entry))
+
+            for key, entry in list(self._entries.items()):
+                if self._query_key(entry['params']) in stale:
+                    del self._entries[key]
+                    self._facility_count -= len(entry['results'])
+                    self.invalidations += 1
+
+    def _query_key(self, params):
+        return json.dumps(dict((k, v) for k, v in params.items()
+                               if k not in ('offset', 'limit')),
+                          sort_keys=True)
+
+    @staticmethod
+    def _contains(entry, uuid):
+        return entry['uuids'] is None or uuid in entry['uuids']
+
+    def _could_match(self, params, data):
+        for name, val in params.items():
+            if name in self.NON_FILTER_PARAMS or name == 'updatedSince':
+                continue
+            elif name == 'active':
+                if _param_value(data.get('active', True)) != _param_value(val):
+                    return False
+            elif name in self.TOP_LEVEL_FILTERS:
+                if _param_value(data.get(name)) != _param_value(val):
+                    return False
+            else:
+                properties = data.get('properties') or {}
+                if name not in properties:
+                    return False
+                elif _param_value(properties[name]) != _param_value(val):
+                    return False
+
+        return True
+
+
+def _param_value(val):
+    """Normalize a value the way it would appear in a url parameter."""
+
+    if isinstance(val, bool):
+        return u'true' if val else u'false'
+    elif val is None:
+        return None
+
+    return unicode(val)
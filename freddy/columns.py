@@ -0,0 +1,143 @@
+import array
+import collections
+import datetime
+from .util import parse_date
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['to_columns']
+
+
+DEFAULT_FIELDS = ('uuid', 'coordinates', 'active', 'updatedAt')
+DATE_FIELDS = ('createdAt', 'updatedAt')
+
+NAN = float('nan')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_columns(rows, fields=DEFAULT_FIELDS, use_numpy=None):
+    """
+    Collects facility data into one array per field, as an OrderedDict.
+
+    With NumPy, coordinates are a float64 array of shape (N, 2) with NaN for
+    missing values, active is a bool array, createdAt and updatedAt are
+    datetime64[ms] arrays in UTC with NaT for missing values, and any other
+    field is an object array.  Without NumPy, coordinates are a flat
+    array.array('d') of N (longitude, latitude) pairs, active is an
+    array.array('b'), dates are an array.array('d') of POSIX timestamps with
+    NaN for missing values, and other fields are lists.
+
+    rows -- iterable of facility data dicts as returned by RegistryAPI
+    fields -- names of facility properties, or 'properties.<name>' for
+        extended properties
+    use_numpy -- whether to return NumPy arrays; defaults to whether NumPy
+        is installed
+
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+
+    columns = [(field, _column_for(field)) for field in fields]
+
+    for row in rows:
+        for field, column in columns:
+            column.append(_get_field(row, field))
+
+    return collections.OrderedDict(
+        (field, column.to_numpy() if use_numpy else column.values)
+        for field, column in columns)
+
+
+def _get_field(row, field):
+    if field.startswith('properties.'):
+        return (row.get('properties') or {}).get(field[len('properties.'):])
+    elif field == 'active':
+        return row.get('active', True)
+    else:
+        return row.get(field)
+
+
+def _column_for(field):
+    if field == 'coordinates':
+        return CoordinatesColumn()
+    elif field == 'active':
+        return BooleanColumn()
+    elif field in DATE_FIELDS:
+        return DateColumn()
+    else:
+        return ObjectColumn()
+
+
+class CoordinatesColumn(object):
+    def __init__(self):
+        self.values = array.array('d')
+
+    def append(self, val):
+        self.values.extend(val[:2] if val else (NAN, NAN))
+
+    def to_numpy(self):
+        return numpy.array(self.values, dtype=numpy.float64).reshape(-1, 2)
+
+
+class BooleanColumn(object):
+    def __init__(self):
+        self.values = array.array('b')
+
+    def append(self, val):
+        self.values.append(bool(val))
+
+    def to_numpy(self):
+        return numpy.array(self.values, dtype=numpy.bool_)
+
+
+class DateColumn(object):
+    """Stores dates as milliseconds since the epoch, converted on output."""
+
+    def __init__(self):
+        self._millis = array.array('d')
+
+    def append(self, val):
+        if val is None:
+            self._millis.append(NAN)
+            return
+
+        if not isinstance(val, datetime.datetime):
+            val = parse_date(val)
+        if val.tzinfo is not None:
+            val = val.replace(tzinfo=None) - val.utcoffset()
+
+        delta = val - EPOCH
+        self._millis.append((delta.days * 86400 + delta.seconds) * 1000.0 +
+                            delta.microseconds // 1000)
+
+    @property
+    def values(self):
+        return array.array('d', (millis / 1000.0 for millis in self._millis))
+
+    def to_numpy(self):
+        millis = numpy.array(self._millis, dtype=numpy.float64)
+        missing = numpy.isnan(millis)
+        millis[missing] = 0
+
+        dates = millis.astype(numpy.int64).astype('datetime64[ms]')
+        dates[missing] = numpy.datetime64('NaT')
+
+        return dates
+
+
+class ObjectColumn(object):
+    def __init__(self):
+        self.values = []
+
+    def append(self, val):
+        self.values.append(val)
+
+    def to_numpy(self):
+        result = numpy.empty(len(self.values), dtype=object)
+        for i, val in enumerate(self.values):
+            result[i] = val
+
+        return result
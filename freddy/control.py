@@ -0,0 +1,196 @@
+import email.utils
+import random
+import requests
+import threading
+import time
+
+__all__ = ['RequestController']
+
+
+class RequestController(object):
+    """
+    Controls the requests made by a RegistryAPI from any number of threads.
+    Failed requests with idempotent methods are retried, and the number of
+    requests allowed in flight at once adapts to what the server can
+    sustain.
+
+    Requests that fail to connect, time out, or get one of RETRY_STATUSES
+    are retried up to max_retries times, waiting as long as the response's
+    Retry-After header asks or otherwise for an exponentially increasing,
+    randomly jittered delay.  Responses asking to wait longer than
+    max_retry_after seconds are returned without retrying.
+
+    The concurrency limit is adjusted AIMD-style: each successful request
+    raises it by 1/limit (about one per round of requests), while an
+    overloaded response, a connection failure, or a response taking more
+    than latency_tolerance times the recent fastest for the same kind of
+    request halves it, at most once per round (the average latency).
+
+    max_concurrency -- upper bound on, and starting value for, the limit
+    min_concurrency -- lower bound on the limit
+    max_retries -- retries per request; 0 disables retrying
+    backoff -- delay in seconds before the first retry without Retry-After
+    max_backoff -- cap on the delay before retries without Retry-After
+    max_retry_after -- longest Retry-After to honor
+    latency_tolerance -- how many times slower than the fastest response a
+        response can be before the server is considered congested, or None
+        to only adapt to errors
+    adaptive -- whether to adapt the concurrency limit at all
+
+    """
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    RETRY_STATUSES = (429, 502, 503, 504)
+    OVERLOAD_STATUSES = (429, 503)
+
+    # responses faster than this never count as slow, since tiny latencies
+    # vary by large factors
+    MIN_SLOW_LATENCY = 0.05
+
+    def __init__(self, max_concurrency=10, min_concurrency=1, max_retries=5,
+                 backoff=0.5, max_backoff=30, max_retry_after=300,
+                 latency_tolerance=4, adaptive=True):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.latency_tolerance = latency_tolerance
+        self.adaptive = adaptive
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.retries = 0
+        self.decreases = 0
+
+        self._fastest = {}
+        self._latency = None
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def send(self, method, path, send):
+        """
+        Call `send` to make a request with method `method` to `path`,
+        retrying as needed, and return the final response.
+
+        """
+        retryable = method.upper() in self.IDEMPOTENT_METHODS
+        attempt = 0
+
+        while True:
+            self._acquire()
+            try:
+                r = send()
+            except (requests.ConnectionError, requests.Timeout):
+                self._release(congested=True)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                self._release(
+                    congested=(r.status_code in self.OVERLOAD_STATUSES or
+                               self._is_slow(method, path, r)))
+
+                if (not retryable or attempt >= self.max_retries or
+                        r.status_code not in self.RETRY_STATUSES):
+                    return r
+
+                delay = self._retry_after(r)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                elif delay > self.max_retry_after:
+                    return r
+
+                r.close()
+
+            attempt += 1
+            with self._condition:
+                self.retries += 1
+
+            time.sleep(delay)
+
+    @property
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'retries': self.retries,
+            'decreases': self.decreases
+        }
+
+    def _acquire(self):
+        with self._condition:
+            while self.in_flight >= max(int(self.limit), 1):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _release(self, congested):
+        with self._condition:
+            self.in_flight -= 1
+
+            if not self.adaptive:
+                pass
+            elif congested:
+                # requests already in flight when the limit was lowered
+                # report the same congestion, so decrease once per round
+                now = time.time()
+                if now - self._last_decrease >= self._round_time():
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_decrease = now
+                    self.decreases += 1
+            else:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
+
+    def _round_time(self):
+        return max(0.1, self._latency or 0)
+
+    def _is_slow(self, method, path, r):
+        elapsed = getattr(r, 'elapsed', None)
+        if elapsed is None:
+            return False
+
+        latency = elapsed.total_seconds()
+        # list requests are much slower than single facility requests
+        key = (method, path.startswith('/facilities.json'))
+
+        with self._condition:
+            self._latency = (latency if self._latency is None
+                             else 0.9 * self._latency + 0.1 * latency)
+
+            # let the baseline drift up slowly, so that one unusually fast
+            # response doesn't make every later one look slow
+            fastest = self._fastest.get(key)
+            if fastest is None or latency < fastest * 1.001:
+                self._fastest[key] = latency
+                return False
+            self._fastest[key] = fastest * 1.001
+
+        return (self.latency_tolerance is not None and
+                latency > self.MIN_SLOW_LATENCY and
+                latency > fastest * self.latency_tolerance)
+
+    def _backoff(self, attempt):
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(r):
+        """The delay in seconds asked for by a Retry-After header, or None."""
+
+        value = r.headers.get('Retry-After')
+        if not value:
+            return None
+
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+
+        return max(0, email.utils.mktime_tz(date) - time.time())
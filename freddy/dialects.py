@@ -0,0 +1,162 @@
+__all__ = ['Dialect', 'DHIS2Dialect', 'ResourceMapDialect', 'get_dialect']
+
+
+class Dialect(object):
+    """
+    Describes how a provider's JSON representation of a facility differs
+    from the Facility Registry API spec.  A dialect is chosen once per
+    RegistryAPI, and builds functions for its field mapping up front, so
+    that converting a facility doesn't involve checking which provider the
+    data came from.
+
+    To support a new provider, subclass Dialect and set FIELD_NAMES and
+    READ_ONLY_FIELDS, or override compile_incoming() and compile_outgoing()
+    for more involved conversions, then pass an instance as the dialect
+    argument of Registry.
+
+    """
+    # spec field name -> the provider's name for it
+    FIELD_NAMES = {}
+
+    # spec fields that the provider sets itself and rejects in request bodies
+    READ_ONLY_FIELDS = ()
+
+    def __init__(self):
+        self.incoming = self.compile_incoming()
+        self.outgoing = self.compile_outgoing()
+
+    def compile_incoming(self):
+        """
+        Returns a function that converts one facility dict from the
+        provider's representation to the spec's, in place.
+
+        """
+        renames = [(provider, spec) for spec, provider
+                   in sorted(self.FIELD_NAMES.items()) if provider != spec]
+
+        return _compile([], renames)
+
+    def compile_outgoing(self):
+        """
+        Returns a function that converts one facility dict from the spec's
+        representation to the provider's, in place.
+
+        """
+        drop = list(self.READ_ONLY_FIELDS)
+        renames = [(spec, provider) for spec, provider
+                   in sorted(self.FIELD_NAMES.items())
+                   if provider != spec and spec not in drop]
+
+        return _compile(drop, renames)
+
+    def incoming_page(self, facilities):
+        """Convert a list of facility dicts from the provider's format."""
+
+        incoming = self.incoming
+        if incoming is _identity:
+            return facilities
+
+        return [incoming(data) for data in facilities]
+
+
+class DHIS2Dialect(Dialect):
+    """DHIS2 follows the spec."""
+
+
+class ResourceMapDialect(Dialect):
+    """
+    Resource Map names the uuid and href fields id and url, and sets them
+    and the timestamps itself.
+
+    """
+    FIELD_NAMES = {
+        'uuid': 'id',
+        'href': 'url'
+    }
+
+    READ_ONLY_FIELDS = ('uuid', 'href', 'createdAt', 'updatedAt')
+
+    # the general conversions loop over the fields to rename or drop, which
+    # costs more than doing it directly when every facility in a list is
+    # converted, so these fields have their own functions
+    def compile_incoming(self):
+        if self.FIELD_NAMES != ResourceMapDialect.FIELD_NAMES:
+            return super(ResourceMapDialect, self).compile_incoming()
+
+        return _resmap_incoming
+
+    def compile_outgoing(self):
+        if (self.FIELD_NAMES != ResourceMapDialect.FIELD_NAMES or
+                self.READ_ONLY_FIELDS != ResourceMapDialect.READ_ONLY_FIELDS):
+            return super(ResourceMapDialect, self).compile_outgoing()
+
+        return _resmap_outgoing
+
+
+DIALECTS = {
+    'dhis2': DHIS2Dialect,
+    'resmap': ResourceMapDialect
+}
+
+
+def get_dialect(url, dialect=None):
+    """
+    Returns a Dialect instance for the API at `url`.
+
+    dialect -- a Dialect instance or subclass, or the name of one in
+        DIALECTS.  By default, Resource Map is detected from the url and
+        anything else is assumed to follow the spec.
+
+    """
+    if dialect is None:
+        dialect = 'resmap' if 'resmap' in url else 'dhis2'
+
+    if isinstance(dialect, basestring):
+        dialect = DIALECTS[dialect]
+    if isinstance(dialect, type):
+        dialect = dialect()
+
+    return dialect
+
+
+def _identity(data):
+    return data
+
+
+def _compile(drop, renames):
+    """
+    Returns a function that removes the keys in `drop` from a dict and
+    renames keys according to the (old, new) pairs in `renames`, in place.
+
+    """
+    if not drop and not renames:
+        return _identity
+
+    drop = tuple(drop)
+    renames = tuple(renames)
+
+    def convert(data):
+        for key in drop:
+            data.pop(key, None)
+        for old, new in renames:
+            if old in data:
+                data[new] = data.pop(old)
+        return data
+
+    return convert
+
+
+def _resmap_incoming(data):
+    if 'id' in data:
+        data['uuid'] = data.pop('id')
+    if 'url' in data:
+        data['href'] = data.pop('url')
+    return data
+
+
+def _resmap_outgoing(data):
+    data.pop('uuid', None)
+    data.pop('href', None)
+    data.pop('createdAt', None)
+    data.pop('updatedAt', None)
+    return data
@@ -0,0 +1,111 @@
+import datetime
+import hashlib
+import json
+import pytz
+import threading
+from .cache import MemoryCache
+from .util import ISO_8601_RE, parse_date
+
+__all__ = ['FingerprintStore', 'fingerprint']
+
+
+# fields set by the server, which aren't part of a facility's content
+SERVER_FIELDS = ('uuid', 'href', 'createdAt', 'updatedAt')
+
+
+def fingerprint(facility):
+    """
+    Returns a stable hash of the content of a Facility or facility dict,
+    which is the same for a facility loaded from the server and a local
+    Facility with the same data.  Server-managed fields are ignored, the
+    order of identifiers doesn't matter, dates are compared in UTC, and
+    missing values, None and empty lists or dicts are equivalent.
+
+    """
+    if hasattr(facility, 'to_dict'):
+        facility = facility.to_dict()
+
+    content = _normalize(dict((k, v) for k, v in facility.items()
+                              if k not in SERVER_FIELDS)) or {}
+    content.setdefault('active', True)
+
+    if 'identifiers' in content:
+        content['identifiers'] = sorted(
+            content['identifiers'],
+            key=lambda i: (i.get('agency'), i.get('context'), i.get('id')))
+
+    encoded = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class FingerprintStore(object):
+    """
+    Remembers the fingerprint of the last known server state of each
+    facility, so that Registry.save() can skip writes that wouldn't change
+    anything.  Facilities are remembered when they're fetched or listed
+    from the server (unless only some fields were selected), saved or
+    created, and forgotten when they're deleted.  Data read from a cache or
+    local backend isn't remembered, since it may be out of date.
+
+    backend -- where to keep fingerprints by uuid: a freddy.cache.MemoryCache
+        (the default), DiskCache, or any object with the same get/set/delete
+        methods
+
+    """
+    def __init__(self, backend=None):
+        self.backend = (backend if backend is not None
+                        else MemoryCache(max_size=100000))
+
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def unchanged(self, facility):
+        """
+        Whether `facility` has the same content as the last known server
+        state.  Counts the write as skipped if so.
+
+        """
+        uuid = facility['uuid']
+        if not uuid:
+            return False
+
+        known = self.backend.get(uuid)
+        if known is None or known != fingerprint(facility):
+            return False
+
+        with self._lock:
+            self.skipped += 1
+
+        return True
+
+    def upsert(self, data):
+        if data.get('uuid'):
+            self.backend.set(data['uuid'], fingerprint(data))
+
+    def delete(self, uuid):
+        self.backend.delete(uuid)
+
+
+def _normalize(val):
+    if isinstance(val, dict):
+        normalized = {}
+        for k, v in val.items():
+            v = _normalize(v)
+            if v is not None:
+                normalized[k] = v
+        return normalized or None
+    elif isinstance(val, (list, tuple)):
+        return [_normalize(v) for v in val] or None
+    elif isinstance(val, bool):
+        return val
+    elif isinstance(val, (int, long, float)):
+        return float(val)
+    elif isinstance(val, basestring) and ISO_8601_RE.match(val):
+        val = parse_date(val)
+
+    if isinstance(val, datetime.datetime):
+        if val.tzinfo is not None:
+            val = val.astimezone(pytz.utc).replace(tzinfo=None)
+        return val.isoformat()
+
+    return val
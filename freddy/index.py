@@ -0,0 +1,129 @@
+import itertools
+import threading
+
+__all__ = ['IdentifierIndex']
+
+
+# every way of leaving parts of an (agency, context, id) key unspecified
+KEY_MASKS = [mask for mask in itertools.product((True, False), repeat=3)
+             if any(mask)]
+
+
+class IdentifierIndex(object):
+    """
+    Maps facility identifiers to facility uuids, for looking up facilities
+    by an external identifier in constant time.  Lookups may leave any of
+    agency, context and id unspecified, e.g. to find every facility with an
+    identifier from a given agency.
+
+    An index created by Registry.index_identifiers() is kept up to date as
+    facilities are saved and deleted through that registry.
+
+    facilities -- iterable of Facility objects or facility dicts to index
+    registry -- optional Registry used to fetch facilities in get_facility()
+
+    """
+    def __init__(self, facilities=(), registry=None):
+        self.registry = registry
+
+        self._uuids = {}
+        self._identifiers = {}
+        self._lock = threading.Lock()
+
+        for facility in facilities:
+            self.upsert(facility)
+
+    @classmethod
+    def from_mirror(cls, mirror, registry=None):
+        """Build an index from the identifiers stored in a LocalMirror."""
+
+        index = cls(registry=registry)
+        for uuid, identifiers in mirror.iter_identifiers():
+            index.add(uuid, identifiers)
+
+        return index
+
+    def lookup(self, agency=None, context=None, id=None):
+        """
+        Returns the set of uuids of facilities that have an identifier
+        matching all of the given agency, context and id.
+
+        """
+        key = (agency, context, id)
+        if key == (None, None, None):
+            return set(self._identifiers)
+
+        return set(self._uuids.get(key, ()))
+
+    def get(self, agency, context, id):
+        """
+        Returns the uuid of the facility with the given identifier, or None.
+
+        """
+        uuids = self._uuids.get((agency, context, id))
+        if not uuids:
+            return None
+        elif len(uuids) > 1:
+            raise ValueError(
+                "More than one facility has identifier {0}".format(
+                    (agency, context, id)))
+
+        return next(iter(uuids))
+
+    def get_facility(self, agency, context, id):
+        """
+        Returns the Facility with the given identifier from the registry, or
+        None.
+
+        """
+        uuid = self.get(agency, context, id)
+        return self.registry.get(uuid) if uuid else None
+
+    def add(self, uuid, identifiers):
+        """Index `uuid` under `identifiers`, replacing its previous ones."""
+
+        keys = set(_keys(identifiers))
+
+        with self._lock:
+            self._remove(uuid)
+
+            self._identifiers[uuid] = keys
+            for key in keys:
+                self._uuids.setdefault(key, set()).add(uuid)
+
+    def upsert(self, facility):
+        """Add or re-index a Facility or facility dict."""
+
+        if hasattr(facility, 'to_dict'):
+            identifiers = facility['identifiers']
+        else:
+            identifiers = facility.get('identifiers')
+
+        self.add(facility['uuid'], identifiers or ())
+
+    def delete(self, uuid):
+        with self._lock:
+            self._remove(uuid)
+
+    def __len__(self):
+        return len(self._identifiers)
+
+    def __contains__(self, uuid):
+        return uuid in self._identifiers
+
+    def _remove(self, uuid):
+        for key in self._identifiers.pop(uuid, ()):
+            uuids = self._uuids[key]
+            uuids.discard(uuid)
+            if not uuids:
+                del self._uuids[key]
+
+
+def _keys(identifiers):
+    for identifier in identifiers:
+        full_key = (identifier.get('agency'), identifier.get('context'),
+                    identifier.get('id'))
+
+        for mask in KEY_MASKS:
+            yield tuple(part if keep else None
+                        for part, keep in zip(full_key, mask))
@@ -0,0 +1,285 @@
+import datetime
+import itertools
+import json
+import pytz
+import sqlite3
+import threading
+from .util import encode_dates, parse_date
+
+__all__ = ['LocalMirror']
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS facilities (
+    uuid TEXT PRIMARY KEY,
+    name TEXT,
+    href TEXT,
+    active INTEGER,
+    createdAt TEXT,
+    updatedAt TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS facilities_name ON facilities (name);
+CREATE INDEX IF NOT EXISTS facilities_active ON facilities (active);
+CREATE INDEX IF NOT EXISTS facilities_updatedAt ON facilities (updatedAt);
+
+CREATE TABLE IF NOT EXISTS identifiers (
+    uuid TEXT NOT NULL,
+    agency TEXT,
+    context TEXT,
+    id TEXT
+);
+CREATE INDEX IF NOT EXISTS identifiers_key
+    ON identifiers (agency, context, id);
+CREATE INDEX IF NOT EXISTS identifiers_uuid ON identifiers (uuid);
+
+CREATE TABLE IF NOT EXISTS properties (
+    uuid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS properties_value ON properties (name, value);
+CREATE INDEX IF NOT EXISTS properties_uuid ON properties (uuid);
+"""
+
+# facility properties stored in their own column, which can be filtered and
+# sorted on directly
+COLUMNS = ('uuid', 'name', 'href', 'active', 'createdAt', 'updatedAt')
+DATE_COLUMNS = ('createdAt', 'updatedAt')
+
+
+class LocalMirror(object):
+    """
+    Local replica of a facility registry stored in an SQLite database, which
+    can answer the same queries as the Facility Registry API.  Pass it as
+    the backend of a Registry to run get() and FacilityQuery queries against
+    the replica instead of the server:
+
+        mirror = LocalMirror('facilities.db')
+        DeltaSync(Registry(url), mirror.upsert).run()
+        registry = Registry(url, backend=mirror)
+
+    Supports the active and updatedSince filters, equality filters on name,
+    uuid, href and extended properties, sorting on any of those, partial
+    responses and ranges.
+
+    path -- database file name, or ':memory:' for a temporary mirror
+
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock:
+            if path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+
+    def upsert(self, facility):
+        """Add or replace a facility, given as a Facility or a dict."""
+
+        self.upsert_many([facility])
+
+    def upsert_many(self, facilities):
+        """Add or replace many facilities in a single transaction."""
+
+        with self._lock:
+            with self._conn:
+                for facility in facilities:
+                    self._upsert(facility)
+
+    def delete(self, uuid):
+        with self._lock:
+            with self._conn:
+                self._delete(uuid)
+
+    def get(self, uuid):
+        """Returns the data for the facility `uuid`, or None."""
+
+        rows = self._execute(
+            'SELECT data FROM facilities WHERE uuid = ?', (uuid,))
+
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_many(self, uuids):
+        """
+        Returns a dict mapping each of `uuids` that is stored to its data.
+
+        """
+        uuids = list(uuids)
+        found = {}
+
+        # stay under SQLite's default limit of 999 bound parameters
+        for i in range(0, len(uuids), 500):
+            chunk = uuids[i:i + 500]
+            rows = self._execute(
+                'SELECT uuid, data FROM facilities WHERE uuid IN ({0})'.format(
+                    ', '.join('?' * len(chunk))), chunk)
+            found.update((uuid, json.loads(data)) for uuid, data in rows)
+
+        return found
+
+    def query(self, params):
+        """
+        Returns a list of facility data matching the FacilityQuery `params`.
+
+        """
+        params = dict(params)
+
+        offset = int(params.pop('offset', 0) or 0)
+        limit = params.pop('limit', 'off')
+        limit = -1 if limit == 'off' else int(limit)
+
+        fields = params.pop('fields', None)
+        params.pop('allProperties', None)
+
+        order = []
+        for param, direction in (('sortAsc', 'ASC'), ('sortDesc', 'DESC')):
+            if param in params:
+                column, args = self._column(params.pop(param))
+                order.append((column, direction, args))
+
+        where, args = [], []
+        for name, val in sorted(params.items()):
+            if name == 'updatedSince':
+                where.append('updatedAt >= ?')
+                args.append(_normalize_date(val))
+            elif name == 'active':
+                where.append('active = ?')
+                args.append(int(val in (True, 'true')))
+            else:
+                column, column_args = self._column(name)
+                values = _filter_values(val)
+                where.append('{0} IN ({1})'.format(
+                    column, ', '.join('?' * len(values))))
+                args.extend(column_args + values)
+
+        sql = 'SELECT data FROM facilities'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        sql += ' ORDER BY ' + ''.join(
+            '{0} {1}, '.format(column, direction)
+            for column, direction, _ in order) + 'uuid'
+        for _, _, column_args in order:
+            args.extend(column_args)
+
+        sql += ' LIMIT ? OFFSET ?'
+        args.extend([limit, offset])
+
+        results = [json.loads(data) for data, in self._execute(sql, args)]
+
+        if fields:
+            fields = fields.split(',')
+            results = [dict((k, v) for k, v in data.items() if k in fields)
+                       for data in results]
+
+        return results
+
+    def iter_identifiers(self):
+        """Yields a (uuid, list of identifiers) tuple for each facility."""
+
+        rows = self._execute('SELECT uuid, agency, context, id '
+                             'FROM identifiers ORDER BY uuid')
+
+        for uuid, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield uuid, [{'agency': agency, 'context': context, 'id': id}
+                         for _, agency, context, id in group]
+
+    def clear(self):
+        with self._lock:
+            with self._conn:
+                for table in ('facilities', 'identifiers', 'properties'):
+                    self._conn.execute('DELETE FROM {0}'.format(table))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM facilities')[0][0]
+
+    def __contains__(self, uuid):
+        return bool(self._execute(
+            'SELECT 1 FROM facilities WHERE uuid = ?', (uuid,)))
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def _column(self, name):
+        if name in COLUMNS:
+            return name, []
+        else:
+            return ('(SELECT value FROM properties AS p WHERE '
+                    'p.uuid = facilities.uuid AND p.name = ?)'), [name]
+
+    def _upsert(self, facility):
+        if hasattr(facility, 'to_dict'):
+            facility = facility.to_dict()
+
+        data = encode_dates(facility)
+        uuid = data['uuid']
+
+        self._delete(uuid)
+        self._conn.execute(
+            'INSERT INTO facilities ({0}, data) VALUES (?, ?, ?, ?, ?, ?, ?)'
+            .format(', '.join(COLUMNS)),
+            [_normalize_date(data.get(c)) if c in DATE_COLUMNS else data.get(c)
+             for c in COLUMNS] + [json.dumps(data)])
+        self._conn.executemany(
+            'INSERT INTO identifiers (uuid, agency, context, id) '
+            'VALUES (?, ?, ?, ?)',
+            [(uuid, i.get('agency'), i.get('context'), i.get('id'))
+             for i in data.get('identifiers') or ()])
+        self._conn.executemany(
+            'INSERT INTO properties (uuid, name, value) VALUES (?, ?, ?)',
+            [(uuid, name, _to_column_value(val))
+             for name, val in (data.get('properties') or {}).items()])
+
+    def _delete(self, uuid):
+        for table in ('facilities', 'identifiers', 'properties'):
+            self._conn.execute(
+                'DELETE FROM {0} WHERE uuid = ?'.format(table), (uuid,))
+
+
+def _normalize_date(val):
+    """
+    Convert a datetime or ISO 8601 string to a naive UTC timestamp string
+    that sorts correctly as text.
+
+    """
+    if val is None:
+        return None
+    if not isinstance(val, datetime.datetime):
+        val = parse_date(val)
+    if val.tzinfo is not None:
+        val = val.astimezone(pytz.utc).replace(tzinfo=None)
+
+    return val.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def _to_column_value(val):
+    if isinstance(val, (list, dict)):
+        return json.dumps(val)
+    return val
+
+
+def _filter_values(val):
+    """
+    Values a filter parameter could match, since FacilityQuery turns
+    booleans into 'true' and 'false' and filters may be given as strings.
+
+    """
+    values = [val]
+    if val in ('true', 'false'):
+        values.append(int(val == 'true'))
+    elif isinstance(val, basestring):
+        try:
+            values.append(float(val))
+        except ValueError:
+            pass
+
+    return values
@@ -0,0 +1,225 @@
+import copy
+import datetime
+from .util import parse_date
+
+__all__ = ['Reconciler', 'Reconciliation', 'by_uuid', 'by_identifier',
+           'compare']
+
+
+# fields set by the server, which local records can't change
+IGNORED_FIELDS = ('uuid', 'href', 'createdAt', 'updatedAt')
+
+
+def by_uuid(data):
+    """Key function matching records to facilities by uuid."""
+
+    return data.get('uuid')
+
+
+def by_identifier(agency, context):
+    """
+    Returns a key function matching records to facilities by their
+    (agency, context, id) identifier with the given agency and context.
+
+    """
+    def key(data):
+        for identifier in data.get('identifiers') or ():
+            if (identifier.get('agency') == agency and
+                    identifier.get('context') == context):
+                return (agency, context, identifier.get('id'))
+
+    return key
+
+
+class Reconciliation(object):
+    """
+    Outcome of Reconciler.diff().
+
+    create -- local records that don't match any facility
+    update -- (facility data, record, diff) tuples for facilities that differ
+        from their record, where diff maps each differing field (or
+        'properties.<name>') to an (old, new) tuple
+    delete -- data of the facilities that don't match any record
+    unchanged -- uuids of the facilities that match their record
+    duplicates -- data of facilities with the same key as an earlier
+        facility, which are left alone
+
+    """
+    def __init__(self):
+        self.create = []
+        self.update = []
+        self.delete = []
+        self.unchanged = []
+        self.duplicates = []
+
+    def __repr__(self):
+        return ("<Reconciliation {0} to create, {1} to update, {2} to delete, "
+                "{3} unchanged>".format(len(self.create), len(self.update),
+                                        len(self.delete), len(self.unchanged)))
+
+
+class Reconciler(object):
+    """
+    Compares an external dataset, such as CommCare HQ locations, against the
+    registry and applies the differences.
+
+    Local records are facility dicts in the same format as the API's.  They
+    are loaded into a hash table by key, and the registry's facilities are
+    streamed past it page by page, so a diff takes time linear in the number
+    of records and facilities.  It holds the records and their keys in
+    memory, along with the data of every facility that needs updating or
+    deleting, or has a duplicate key, and the uuids of the unchanged ones,
+    so when most of the registry has no record, the facilities to delete
+    take up most of the memory.  Only the fields present in a record are
+    compared, and of its extended properties only the ones it has.  Facilities for which the key function returns None aren't
+    considered, e.g. ones without the identifier being matched on.
+
+    registry -- the Registry to reconcile against
+    key -- function returning the key of a record or facility dict, such as
+        by_uuid (the default) or by_identifier(agency, context)
+    page_size -- number of facilities to request at a time
+    prefetch -- number of pages to request at once
+
+    """
+    def __init__(self, registry, key=by_uuid, page_size=500, prefetch=4):
+        self.registry = registry
+        self.key = key
+        self.page_size = page_size
+        self.prefetch = prefetch
+
+    def diff(self, records, query=None):
+        """
+        Match `records` against the facilities from `query` (by default,
+        all facilities).  Returns a Reconciliation.
+
+        """
+        key = self.key
+        result = Reconciliation()
+
+        local = {}
+        for record in records:
+            k = key(record)
+            if k is None:
+                result.create.append(record)
+            elif k in local:
+                raise ValueError("More than one record has key {0}".format(k))
+            else:
+                local[k] = record
+
+        if query is None:
+            query = self.registry.facilities
+        # the caller's query is left as it was
+        query = copy.copy(query).raw()
+        if self.prefetch:
+            query.prefetch(self.prefetch)
+
+        matched = set()
+        for data in query.range(page_size=self.page_size):
+            k = key(data)
+            if k is None:
+                continue
+            elif k in matched:
+                result.duplicates.append(data)
+                continue
+
+            record = local.get(k)
+            if record is None:
+                result.delete.append(data)
+                continue
+
+            matched.add(k)
+
+            changes = compare(data, record)
+            if changes:
+                result.update.append((data, record, changes))
+            else:
+                result.unchanged.append(data.get('uuid'))
+
+        result.create.extend(record for k, record in local.iteritems()
+                             if k not in matched)
+
+        return result
+
+    def apply(self, reconciliation, delete=False, max_workers=10):
+        """
+        Create and update facilities to match their records, through a
+        Registry.session().  Returns a SessionResult.
+
+        delete -- whether to also delete the facilities without a record
+        max_workers -- maximum number of requests in flight at once
+
+        """
+        session = self.registry.session(max_workers=max_workers)
+
+        for record in reconciliation.create:
+            session.create(dict((k, v) for k, v in record.items()
+                                if k not in IGNORED_FIELDS))
+
+        for data, record, changes in reconciliation.update:
+            facility = session.add(self.registry.Facility(new=False, **data))
+
+            for field, (old, new) in changes.items():
+                if field.startswith('properties.'):
+                    facility['properties'][field[len('properties.'):]] = new
+                else:
+                    facility[field] = new
+
+        if delete:
+            for data in reconciliation.delete:
+                session.delete(self.registry.Facility(new=False, **data))
+
+        return session.commit()
+
+
+def compare(data, record):
+    """
+    Returns a dict mapping each field of `record` that differs from the
+    facility `data` to an (old, new) tuple.  Extended properties are
+    compared individually, as 'properties.<name>'.
+
+    """
+    changes = {}
+
+    for field, new in record.items():
+        if field in IGNORED_FIELDS:
+            continue
+        elif field == 'properties':
+            properties = data.get('properties') or {}
+            for name, val in (new or {}).items():
+                old = properties.get(name)
+                if not _equal(old, val):
+                    changes['properties.' + name] = (old, val)
+            continue
+
+        old = data.get(field, True if field == 'active' else None)
+
+        if field == 'identifiers':
+            equal = _identifier_set(old) == _identifier_set(new)
+        elif field == 'coordinates':
+            equal = _coordinates(old) == _coordinates(new)
+        else:
+            equal = _equal(old, new)
+
+        if not equal:
+            changes[field] = (old, new)
+
+    return changes
+
+
+def _equal(a, b):
+    # the registry returns dates as strings
+    if isinstance(a, datetime.datetime) and isinstance(b, basestring):
+        b = parse_date(b)
+    elif isinstance(b, datetime.datetime) and isinstance(a, basestring):
+        a = parse_date(a)
+
+    return a == b
+
+
+def _identifier_set(identifiers):
+    return set((i.get('agency'), i.get('context'), i.get('id'))
+               for i in identifiers or ())
+
+
+def _coordinates(coordinates):
+    return [float(c) for c in coordinates] if coordinates else None
@@ -0,0 +1,208 @@
+import collections
+import gzip
+import mmap
+import os
+import shutil
+import tempfile
+from .util import get_default_codec
+
+__all__ = ['Snapshot', 'write_snapshot']
+
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# each line is written with the uuid first, so the index can be built
+# without decoding whole facilities
+UUID_PREFIX = '{"uuid": "'
+
+
+def write_snapshot(facilities, path, codec=None, compress=None):
+    """
+    Write facility data dicts to `path` as newline-delimited JSON, one
+    facility per line, without holding more than one facility in memory.
+    The file is replaced atomically once it's complete.  Returns the number
+    of facilities written.
+
+    facilities -- iterable of facility data dicts as returned by RegistryAPI
+    codec -- JSON codec used to encode facilities
+    compress -- whether to gzip the file.  Defaults to whether `path` ends
+        in .gz.
+
+    """
+    codec = codec or get_default_codec()
+    if compress is None:
+        compress = path.endswith('.gz')
+
+    tmp_path = path + '.tmp'
+    f = gzip.open(tmp_path, 'wb') if compress else open(tmp_path, 'wb')
+
+    count = 0
+    try:
+        try:
+            for data in facilities:
+                data = dict(data)
+                uuid = codec.dumps(data.pop('uuid', None))
+                rest = codec.dumps(data)[1:]
+
+                f.write('{"uuid": ')
+                f.write(uuid)
+                f.write(', ' + rest if rest != '}' else rest)
+                f.write('\n')
+                count += 1
+        finally:
+            f.close()
+
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return count
+
+
+class Snapshot(object):
+    """
+    Read-only access to a snapshot written by Registry.export_snapshot().
+    The file is memory-mapped and indexed by uuid when opened, so looking up
+    a facility only decodes its own line, and iterating only builds Facility
+    objects for the facilities that are asked for.  Compressed snapshots
+    are decompressed to a temporary file first.
+
+    path -- the snapshot file
+    registry -- optional Registry to bind facilities to, so that they can be
+        saved
+    codec -- JSON codec used to decode facilities
+
+    """
+    def __init__(self, path, registry=None, codec=None):
+        self.path = path
+        self.registry = registry
+        self.codec = codec or get_default_codec()
+
+        self._file = self._open(path)
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self._map = ''
+
+        self._offsets = collections.OrderedDict()
+        for uuid, start, end in self._scan():
+            self._offsets[uuid] = (start, end)
+
+    def get(self, uuid):
+        """Returns the Facility with uuid `uuid`, or None."""
+
+        data = self.get_data(uuid)
+        return self._facility(data) if data is not None else None
+
+    def get_data(self, uuid):
+        """Returns the data dict of the facility `uuid`, or None."""
+
+        try:
+            start, end = self._offsets[uuid]
+        except KeyError:
+            return None
+
+        return self.codec.loads(self._map[start:end])
+
+    def iter_facilities(self, predicate=None, uuids=None, readonly=False):
+        """
+        Yields the facilities in the snapshot, in the order they were
+        written.
+
+        predicate -- optional function called with the data dict of each
+            facility; only facilities it returns true for are yielded
+        uuids -- optional iterable of uuids to restrict iteration to, in the
+            given order
+        readonly -- whether to yield ReadOnlyFacility objects
+
+        """
+        if uuids is None:
+            offsets = self._offsets.itervalues()
+        else:
+            offsets = (self._offsets[uuid] for uuid in uuids
+                       if uuid in self._offsets)
+
+        for start, end in offsets:
+            data = self.codec.loads(self._map[start:end])
+            if predicate is None or predicate(data):
+                yield self._facility(data, readonly=readonly)
+
+    def uuids(self):
+        return list(self._offsets)
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_facilities()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, uuid):
+        return uuid in self._offsets
+
+    @staticmethod
+    def _open(path):
+        f = open(path, 'rb')
+        if f.read(2) != GZIP_MAGIC:
+            f.seek(0)
+            return f
+
+        f.close()
+        tmp = tempfile.TemporaryFile()
+        with gzip.open(path, 'rb') as compressed:
+            shutil.copyfileobj(compressed, tmp)
+        tmp.flush()
+
+        return tmp
+
+    def _scan(self):
+        """Yields the uuid, start and end offset of each line."""
+
+        mm = self._map
+        size = len(mm)
+        start = 0
+
+        while start < size:
+            end = mm.find('\n', start)
+            if end == -1:
+                end = size
+
+            if end > start:
+                yield self._uuid(start, end), start, end
+
+            start = end + 1
+
+    def _uuid(self, start, end):
+        mm = self._map
+
+        if mm[start:start + len(UUID_PREFIX)] == UUID_PREFIX:
+            uuid_start = start + len(UUID_PREFIX)
+            uuid_end = mm.find('"', uuid_start, end)
+            uuid = mm[uuid_start:uuid_end]
+            if uuid_end != -1 and '\\' not in uuid:
+                return uuid.decode('utf-8')
+
+        return self.codec.loads(mm[start:end])['uuid']
+
+    def _facility(self, data, readonly=False):
+        from . import Facility, ReadOnlyFacility
+
+        if readonly:
+            return ReadOnlyFacility(data, registry=self.registry)
+        elif self.registry is not None:
+            return self.registry.Facility(new=False, **data)
+
+        return Facility(new=False, **data)
@@ -0,0 +1,246 @@
+import math
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['SpatialIndex', 'haversine']
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine(lon, lat, lons, lats):
+    """
+    Returns the great-circle distances in km from (lon, lat) to each of the
+    points given by the sequences `lons` and `lats`, as a list.
+
+    """
+    if numpy is not None and len(lons) > 16:
+        lons = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+        lats = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+        lon, lat = math.radians(lon), math.radians(lat)
+
+        a = (numpy.sin((lats - lat) / 2) ** 2 + math.cos(lat) *
+             numpy.cos(lats) * numpy.sin((lons - lon) / 2) ** 2)
+        return list(2 * EARTH_RADIUS_KM *
+                    numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0))))
+
+    lon, lat = math.radians(lon), math.radians(lat)
+    cos_lat = math.cos(lat)
+
+    distances = []
+    for other_lon, other_lat in zip(lons, lats):
+        other_lon, other_lat = (math.radians(other_lon),
+                                math.radians(other_lat))
+        a = (math.sin((other_lat - lat) / 2) ** 2 + cos_lat *
+             math.cos(other_lat) * math.sin((other_lon - lon) / 2) ** 2)
+        distances.append(
+            2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1))))
+
+    return distances
+
+
+class SpatialIndex(object):
+    """
+    Grid index over facility coordinates for nearest-facility, radius and
+    bounding box queries.  Points are bucketed into cells of cell_size
+    degrees, so a query only computes distances to facilities in the cells
+    it overlaps.  Coordinates are [longitude, latitude], as in the API.
+    Queries don't wrap around the antimeridian.
+
+    An index created by Registry.index_coordinates() is kept up to date as
+    facilities are saved and deleted through that registry.
+
+    facilities -- iterable of Facility objects or facility dicts to index
+    cell_size -- grid cell size in degrees
+    registry -- optional Registry used to fetch facilities in
+        get_facilities()
+
+    """
+    def __init__(self, facilities=(), cell_size=0.5, registry=None):
+        self.cell_size = float(cell_size)
+        self.registry = registry
+
+        self._points = {}
+        self._cells = {}
+        self._lock = threading.Lock()
+
+        for facility in facilities:
+            self.upsert(facility)
+
+    @classmethod
+    def from_mirror(cls, mirror, **kwargs):
+        """Build an index of the facilities stored in a LocalMirror."""
+
+        return cls(mirror.query({'fields': 'uuid,coordinates'}), **kwargs)
+
+    def nearest(self, point, k=1):
+        """
+        Returns a list of (uuid, distance in km) tuples for the k facilities
+        nearest to `point`, closest first.
+
+        """
+        lon, lat = point
+        if not self._points or k < 1:
+            return []
+
+        cx, cy = self._cell(lon, lat)
+        max_ring = self._max_ring(cx, cy)
+
+        # expand rings of cells around the point until there are k
+        # candidates, then find everything within the k-th candidate's
+        # distance, which may include points in cells outside the rings
+        candidates = []
+        for ring in range(max_ring + 1):
+            candidates.extend(self._ring(cx, cy, ring))
+            if len(candidates) >= k:
+                break
+
+        candidates, lons, lats = self._coordinates(candidates)
+        if not candidates:
+            return []
+
+        radius = sorted(haversine(lon, lat, lons, lats))[
+            min(k, len(candidates)) - 1]
+
+        return self.within_radius(point, radius)[:k]
+
+    def within_radius(self, point, km):
+        """
+        Returns a list of (uuid, distance in km) tuples for the facilities
+        within `km` of `point`, closest first.
+
+        """
+        lon, lat = point
+        dlat = km / KM_PER_DEGREE
+        cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90)))
+        dlon = 180 if cos_lat < 1e-9 else min(km / (KM_PER_DEGREE * cos_lat),
+                                              180)
+
+        candidates = self._in_bbox(lon - dlon, lat - dlat,
+                                   lon + dlon, lat + dlat)
+        candidates, lons, lats = self._coordinates(candidates)
+        distances = haversine(lon, lat, lons, lats)
+
+        # allow for floating point error at the boundary
+        return sorted(((uuid, distance)
+                       for uuid, distance in zip(candidates, distances)
+                       if distance <= km * (1 + 1e-9)),
+                      key=lambda result: result[1])
+
+    def within_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Returns the uuids of facilities inside the bounding box."""
+
+        candidates, lons, lats = self._coordinates(
+            self._in_bbox(min_lon, min_lat, max_lon, max_lat))
+
+        return [uuid for uuid, lon, lat in zip(candidates, lons, lats)
+                if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat]
+
+    def get_facilities(self, results):
+        """
+        Fetch the facilities for a list of uuids or (uuid, distance) tuples
+        from the registry.
+
+        """
+        return [self.registry.get(r[0] if isinstance(r, tuple) else r)
+                for r in results]
+
+    def upsert(self, facility):
+        """Add or move a Facility or facility dict."""
+
+        if hasattr(facility, 'to_dict'):
+            coordinates = facility['coordinates']
+        else:
+            coordinates = facility.get('coordinates')
+
+        if coordinates:
+            self.add(facility['uuid'], coordinates)
+        else:
+            self.delete(facility['uuid'])
+
+    def add(self, uuid, coordinates):
+        lon, lat = float(coordinates[0]), float(coordinates[1])
+
+        with self._lock:
+            self._remove(uuid)
+
+            self._points[uuid] = (lon, lat)
+            self._cells.setdefault(self._cell(lon, lat), set()).add(uuid)
+
+    def delete(self, uuid):
+        with self._lock:
+            self._remove(uuid)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, uuid):
+        return uuid in self._points
+
+    def _remove(self, uuid):
+        point = self._points.pop(uuid, None)
+        if point is None:
+            return
+
+        cell = self._cell(*point)
+        self._cells[cell].discard(uuid)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def _cell(self, lon, lat):
+        return (int(math.floor(lon / self.cell_size)),
+                int(math.floor(lat / self.cell_size)))
+
+    def _max_ring(self, cx, cy):
+        with self._lock:
+            cells = list(self._cells)
+
+        return max([max(abs(x - cx), abs(y - cy)) for x, y in cells] or [0])
+
+    def _ring(self, cx, cy, ring):
+        cells = self._cells
+        if ring == 0:
+            keys = [(cx, cy)]
+        else:
+            xs = range(cx - ring, cx + ring + 1)
+            ys = range(cy - ring + 1, cy + ring)
+            keys = ([(x, cy - ring) for x in xs] +
+                    [(x, cy + ring) for x in xs] +
+                    [(cx - ring, y) for y in ys] +
+                    [(cx + ring, y) for y in ys])
+
+        with self._lock:
+            return [uuid for key in keys for uuid in cells.get(key, ())]
+
+    def _in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        min_x, min_y = self._cell(max(min_lon, -180), max(min_lat, -90))
+        max_x, max_y = self._cell(min(max_lon, 180), min(max_lat, 90))
+
+        with self._lock:
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self._cells):
+                return [uuid for (x, y), uuids in self._cells.items()
+                        if min_x <= x <= max_x and min_y <= y <= max_y
+                        for uuid in uuids]
+
+            return [uuid for x in range(min_x, max_x + 1)
+                    for y in range(min_y, max_y + 1)
+                    for uuid in self._cells.get((x, y), ())]
+
+    def _coordinates(self, uuids):
+        """
+        Returns the uuids that are still indexed, with their longitudes and
+        latitudes.
+
+        """
+        with self._lock:
+            points = [(uuid, self._points[uuid]) for uuid in uuids
+                      if uuid in self._points]
+
+        return ([uuid for uuid, _ in points],
+                [point[0] for _, point in points],
+                [point[1] for _, point in points])
@@ -0,0 +1,150 @@
+import datetime
+import json
+import os
+from .util import parse_date
+
+__all__ = ['DeltaSync', 'FileCheckpoint', 'MemoryCheckpoint']
+
+
+class MemoryCheckpoint(object):
+    """Keeps DeltaSync state in memory, for the life of the process."""
+
+    def __init__(self, state=None):
+        self.state = state
+
+    def load(self):
+        return self.state
+
+    def save(self, state):
+        self.state = state
+
+
+class FileCheckpoint(object):
+    """
+    Persists DeltaSync state to a JSON file.  The file is replaced
+    atomically, so an interrupted write never loses the previous checkpoint.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def save(self, state):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.path)
+
+
+class DeltaSync(object):
+    """
+    Incrementally fetches the facilities that have changed since the last
+    sync, using the updatedSince filter, and passes each one to `handler`.
+
+    Facilities are requested in ascending order of updatedAt.  Each page is
+    requested from the latest updatedAt seen so far, so that facilities
+    updated during the sync can't cause others to be skipped, and from an
+    offset past the facilities already seen with exactly that timestamp.
+    Since the server may not return facilities with the same timestamp in
+    the same order every time, each request starts a page early and skips
+    the uuids seen on the last page.  A facility whose position among those
+    with the same timestamp moves by up to a page between requests is then
+    still handled, though possibly twice.  The position is checkpointed
+    after each page, and an interrupted sync resumes where it left off.  A
+    new sync starts `overlap` before the latest timestamp previously seen,
+    to allow for clock skew between the servers that write facilities.
+    This relies on the updatedSince filter being inclusive.
+
+    Deleted facilities are not reported, since the API doesn't list them.
+
+    registry -- the Registry to sync from
+    handler -- function called with each new or updated Facility, e.g. the
+        upsert() method of a local store
+    checkpoint -- where to persist the sync position: a FileCheckpoint,
+        MemoryCheckpoint (the default) or any object with the same
+        load/save methods
+    page_size -- number of facilities to request at a time
+    overlap -- datetime.timedelta to re-fetch before the previous position
+        when starting a new sync
+
+    """
+    def __init__(self, registry, handler, checkpoint=None, page_size=500,
+                 overlap=datetime.timedelta(minutes=5)):
+        self.registry = registry
+        self.handler = handler
+        self.checkpoint = (checkpoint if checkpoint is not None
+                           else MemoryCheckpoint())
+        self.page_size = page_size
+        self.overlap = overlap
+
+    @property
+    def high_water_mark(self):
+        """The latest updatedAt seen so far, or None before the first sync."""
+
+        state = self.checkpoint.load()
+        if state and state['cursor']:
+            return parse_date(state['cursor'])
+
+    def run(self):
+        """Sync all outstanding changes.  Returns the number handled."""
+
+        state = self.checkpoint.load() or {'cursor': None, 'ties': 0,
+                                           'seen': [], 'complete': True}
+        cursor = state['cursor'] and parse_date(state['cursor'])
+        seen = state.get('seen', [])
+        ties = state.get('ties', len(seen))
+
+        if cursor and state['complete']:
+            cursor, ties, seen = cursor - self.overlap, 0, []
+
+        count = 0
+        while True:
+            # `ties` facilities have been seen with the cursor timestamp, and
+            # `seen` holds the uuids of the last of them.  Slicing copies it,
+            # so the list saved in the checkpoint isn't changed.
+            seen = seen[-self.page_size:]
+            skip = set(seen)
+            limit = len(seen) + self.page_size
+            page = list(self._query(cursor, ties - len(seen), limit))
+
+            for facility in page:
+                uuid = facility['uuid']
+                updated_at = facility['updatedAt']
+                if updated_at == cursor and uuid in skip:
+                    continue
+
+                self.handler(facility)
+                count += 1
+
+                if updated_at is None:
+                    continue
+                elif cursor is None or updated_at > cursor:
+                    cursor, ties, seen = updated_at, 1, [uuid]
+                elif updated_at == cursor:
+                    ties += 1
+                    seen.append(uuid)
+
+            complete = len(page) < limit
+
+            self.checkpoint.save({
+                'cursor': cursor and cursor.isoformat(),
+                'ties': ties,
+                'seen': seen[-self.page_size:],
+                'complete': complete
+            })
+
+            if complete:
+                return count
+
+    def _query(self, cursor, offset, limit):
+        query = self.registry.facilities.sort_asc('updatedAt')
+        if cursor:
+            query = query.filter(updatedSince=cursor)
+
+        return query.range(offset, offset + limit, page_size=limit)
@@ -1,10 +1,31 @@
 import unittest
 import freddy
+import freddy.cache
+import freddy.columns
+import freddy.control
+import freddy.dialects
+import freddy.fingerprint
+import freddy.index
+import freddy.mirror
+import freddy.reconcile
+import freddy.sync
+import freddy.util
 from dateutil.parser import parse
+import BaseHTTPServer
+import SocketServer
 import datetime
+import gc
+import json
+import multiprocessing.pool
+import os
+import shutil
+import tempfile
 import pytz
 import requests
+import threading
 import time
+import urlparse
+from uuid import uuid4
 
 def random_string():
     import random
@@ -19,6 +40,191 @@ def utcnow():
             tzinfo=pytz.utc, microsecond=0)
 
 
+class StubRegistryServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """
+    Minimal in-process implementation of the Facility Registry API, used to
+    run the test suite offline.  Records every request it receives.
+
+    facilities -- facility dicts to seed the registry with
+
+    Set the delay attribute to a number of seconds to wait before handling
+    each request, and add (status, headers) tuples to the failures list to
+    fail the next requests with those responses.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, facilities=()):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StubRegistryHandler)
+
+        self.facilities = dict((f['uuid'], dict(f)) for f in facilities)
+        self.requests = []
+        self.last_body = None
+        self.connections = 0
+        self.delay = 0
+        self.failures = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+
+        with self.server.lock:
+            self.server.requests.append((method, path, params))
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        with self.server.lock:
+            failure = (self.server.failures.pop(0) if self.server.failures
+                       else None)
+        if failure:
+            if method in ('POST', 'PUT'):
+                self._read_body()
+            return self._respond(failure[0], {'code': failure[0]},
+                                 headers=failure[1])
+
+        if path == '/facilities.json':
+            if method == 'GET':
+                return self._list(params)
+            elif method == 'POST':
+                return self._create(self._read_body())
+        elif path.startswith('/facilities/') and path.endswith('.json'):
+            id = path[len('/facilities/'):-len('.json')]
+            if id not in self.server.facilities:
+                return self._respond(404, {'code': 404,
+                                           'message': 'Facility not found'})
+            elif method == 'GET':
+                return self._get(self.server.facilities[id])
+            elif method == 'PUT':
+                return self._update(id, self._read_body())
+            elif method == 'DELETE':
+                del self.server.facilities[id]
+                return self._respond(200)
+
+        self._respond(404)
+
+    def _list(self, params):
+        facilities = sorted(self.server.facilities.values(),
+                            key=lambda f: f['uuid'])
+
+        if 'active' in params:
+            active = params['active'] == 'true'
+            facilities = [f for f in facilities if f['active'] == active]
+        if 'updatedSince' in params:
+            since = parse(params['updatedSince'])
+            facilities = [f for f in facilities
+                          if parse(f['updatedAt']) >= since]
+
+        for param, reverse in (('sortAsc', False), ('sortDesc', True)):
+            if param in params:
+                prop = params[param]
+                key = ((lambda f: parse(f[prop]))
+                       if prop in freddy.Facility.DATE_PROPERTIES
+                       else (lambda f: f.get(prop)))
+                facilities.sort(key=key, reverse=reverse)
+
+        offset = int(params.get('offset', 0))
+        limit = params.get('limit', 'off')
+        end = None if limit == 'off' else offset + int(limit)
+        facilities = facilities[offset:end]
+
+        if params.get('fields'):
+            fields = params['fields'].split(',')
+            facilities = [dict((k, f[k]) for k in fields if k in f)
+                          for f in facilities]
+
+        self._respond(200, {'facilities': facilities})
+
+    def _get(self, facility):
+        etag = '"{0}"'.format(facility['updatedAt'])
+        if self.headers.get('If-None-Match') == etag:
+            return self._respond(304, headers={'ETag': etag})
+
+        self._respond(200, facility, headers={'ETag': etag})
+
+    def _create(self, data):
+        data['uuid'] = unicode(uuid4())
+        data['href'] = '{0}/facilities/{1}'.format(
+            self.server.url, data['uuid'])
+        data['createdAt'] = data['updatedAt'] = utcnow().isoformat()
+        data.setdefault('active', True)
+        data.setdefault('identifiers', [])
+        data.setdefault('properties', {})
+
+        self.server.facilities[data['uuid']] = data
+        self._respond(201, data, headers={'Location': data['href']})
+
+    def _update(self, id, data):
+        facility = self.server.facilities[id]
+        facility.update(data)
+        facility['uuid'] = id
+        facility['updatedAt'] = utcnow().isoformat()
+
+        self._respond(200, facility)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length)) if length else {}
+        self.server.last_body = data
+
+        return data
+
+    def _respond(self, status, data=None, headers=None):
+        body = json.dumps(data) if data is not None else ''
+        if status == 304:
+            body = None
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
 class TestFacilityRegistry(unittest.TestCase):
     url = None
     username = None
@@ -160,6 +366,9 @@ class TestFacilityRegistry(unittest.TestCase):
 
     @unittest.expectedFailure
     def test_get_facility_partial_response(self):
+        self._test_get_facility_partial_response()
+
+    def _test_get_facility_partial_response(self):
         facilities = self.registry.facilities.filter(
             active=False
         ).select('href', 'createdAt')
@@ -232,6 +441,1354 @@ class TestResourceMapFacilityRegistry(TestFacilityRegistry):
     updated_since_test_date = parse("2013-02-05T04:55:59Z")
 
 
+class TestStubFacilityRegistry(TestFacilityRegistry):
+    """Runs the API test suite against a local StubRegistryServer."""
+
+    existing_facility = {
+        'uuid': 'b1c9eff6-92e0-465b-8e33-71012171eeb2',
+        'name': "Panderu MCHP",
+        'createdAt': parse("2012-02-17T14:54:39.987+0000"),
+        'identifiers': [
+            {
+                'agency': 'DHIS2',
+                'context': 'DHIS2_CODE',
+                'id': 'OU_222702'
+            }
+        ]
+    }
+
+    inactive_facility_uuid = "5d9fbd1d-a2f5-441d-9238-60ae94f327b0"
+    inactive_facilities_count_upper_bound = 10
+
+    updated_since_test_date = parse("2013-03-21T18:09:52Z")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubRegistryServer(cls._seed_facilities())
+        cls.server.start()
+        cls.url = cls.server.url
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    @classmethod
+    def _seed_facilities(cls):
+        facilities = [{
+            'uuid': cls.existing_facility['uuid'],
+            'name': cls.existing_facility['name'],
+            'href': 'http://example.com/facilities/1',
+            'createdAt': "2012-02-17T14:54:39.987+0000",
+            'updatedAt': "2013-02-17T14:54:39.987+0000",
+            'identifiers': cls.existing_facility['identifiers'],
+            'coordinates': [-11.5, 8.2],
+            'active': True,
+            'properties': {}
+        }, {
+            'uuid': cls.inactive_facility_uuid,
+            'name': "Closed CHC",
+            'href': 'http://example.com/facilities/2',
+            'createdAt': "2012-02-17T14:54:39.987+0000",
+            'updatedAt': "2013-04-01T10:00:00.000+0000",
+            'identifiers': [],
+            'coordinates': [-11.2, 8.4],
+            'active': False,
+            'properties': {}
+        }]
+
+        for i in range(25):
+            facilities.append({
+                'uuid': 'facility-{0:02d}'.format(i),
+                'name': 'Facility {0}'.format(i),
+                'href': 'http://example.com/facilities/{0}'.format(i + 3),
+                'createdAt': "2012-05-01T00:00:00.000+0000",
+                'updatedAt': "2013-0{0}-01T00:00:00.000+0000".format(
+                    i % 9 + 1),
+                'identifiers': [],
+                'coordinates': [i * 0.1, i * -0.1],
+                'active': True,
+                'properties': {'beds': i}
+            })
+
+        # facility-06, for comparing identifiers in a different order
+        facilities[8]['identifiers'] = [
+            {'agency': 'MOH', 'context': 'code', 'id': 'F06'},
+            {'agency': 'MOH', 'context': 'legacy_code', 'id': '6'}]
+
+        return facilities
+
+    def setUp(self):
+        super(TestStubFacilityRegistry, self).setUp()
+        del self.server.requests[:]
+
+    def test_get_facility_partial_response(self):
+        self._test_get_facility_partial_response()
+
+    def test_concurrent_gets_are_coalesced(self):
+        uuid = 'facility-03'
+        self.server.delay = 0.2
+        try:
+            pool = multiprocessing.pool.ThreadPool(5)
+            facilities = pool.map(self.registry.get, [uuid] * 5)
+            pool.close()
+        finally:
+            self.server.delay = 0
+
+        self.assertEqual(1, len(self.server.requests))
+        self.assertTrue(all(f['uuid'] == uuid for f in facilities))
+
+        facilities[0]['coordinates'].append(0)
+        self.assertEqual(2, len(facilities[1]['coordinates']))
+
+    def test_get_many(self):
+        ids = ['facility-05', 'missing-1', 'facility-02', 'facility-05',
+               'missing-2']
+
+        facilities, missing = self.registry.get_many(ids)
+
+        self.assertEqual(['facility-05', 'facility-02', 'facility-05'],
+                         [f['uuid'] for f in facilities])
+        self.assertEqual(['missing-1', 'missing-2'], missing)
+        self.assertIsNot(facilities[0]['properties'],
+                         facilities[2]['properties'])
+        self.assertEqual(4, len(self.server.requests))
+
+    def test_get_many_from_backend(self):
+        mirror = freddy.mirror.LocalMirror()
+        mirror.upsert_many(self.registry.facilities.filter(active=True))
+        self.registry.backend = mirror
+        del self.server.requests[:]
+
+        facilities, missing = self.registry.get_many(
+            ['facility-07', 'facility-01', 'missing'])
+
+        self.assertEqual(['facility-07', 'facility-01'],
+                         [f['uuid'] for f in facilities])
+        self.assertEqual(['missing'], missing)
+        self.assertEqual([('GET', '/facilities/missing.json', {})],
+                         self.server.requests)
+
+    def test_connections_are_reused(self):
+        connections = self.server.connections
+        for i in range(5):
+            self.registry.get(self.existing_facility['uuid'])
+
+        self.assertEqual(connections + 1, self.server.connections)
+
+    def test_paged_iteration(self):
+        self.registry.page_size = 10
+
+        facilities = list(self.registry.facilities.all())
+        self.assertEqual(len(self.server.facilities), len(facilities))
+
+        offsets = [params['offset'] for _, _, params in self.server.requests]
+        self.assertEqual(['0', '10', '20'], offsets)
+
+    def test_iter_pages_is_lazy(self):
+        facilities = self.registry.facilities.iter_pages(page_size=5)
+        next(facilities)
+
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual('5', self.server.requests[0][2]['limit'])
+
+    def test_range(self):
+        facilities = list(self.registry.facilities.range(3, 17, page_size=5))
+
+        self.assertEqual(14, len(facilities))
+        self.assertEqual([('3', '5'), ('8', '5'), ('13', '4')],
+                         [(p['offset'], p['limit'])
+                          for _, _, p in self.server.requests])
+
+    def test_prefetched_pages(self):
+        expected = [f['uuid'] for f in self.registry.facilities.range(
+            2, 23, page_size=4)]
+        del self.server.requests[:]
+
+        self.server.delay = 0.05
+        try:
+            query = self.registry.facilities.prefetch(pages=3)
+            facilities = [f['uuid'] for f in query.range(2, 23, page_size=4)]
+        finally:
+            self.server.delay = 0
+
+        self.assertEqual(expected, facilities)
+        self.assertEqual(['2', '6', '10', '14', '18', '22'],
+                         sorted((p['offset'] for _, _, p in
+                                 self.server.requests), key=int))
+
+    def test_prefetched_pages_propagate_errors(self):
+        def query_function(params, **kwargs):
+            if params['offset'] == 10:
+                raise freddy.FredError("page failed")
+            return [{'uuid': str(i)} for i in
+                    range(params['offset'], params['offset'] +
+                          params['limit'])]
+
+        query = freddy.FacilityQuery(query_function, page_size=5)
+        facilities = query.prefetch(pages=4).all()
+
+        self.assertEqual([str(i) for i in range(10)],
+                         [next(facilities)['uuid'] for i in range(10)])
+        self.assertRaises(freddy.FredError, next, facilities)
+
+    def test_async_registry(self):
+        with freddy.AsyncRegistry(self.registry, concurrency=4) as registry:
+            facility = registry.create(name=random_string(),
+                                       coordinates=[1.0, 2.0])
+            saved = registry.save(facility).get()
+            self._created_facility_uuids.append(saved['uuid'])
+
+            results = [registry.get(saved['uuid']) for i in range(8)]
+            self.assertTrue(all(r.get()['name'] == facility['name']
+                                for r in results))
+
+            missing = registry.get('missing')
+            with self.assertRaises(freddy.FredHttpError):
+                missing.get()
+
+    def test_async_registry_list_pages(self):
+        pages = []
+        with freddy.AsyncRegistry(self.registry) as registry:
+            query = registry.facilities.filter(active=True)
+            query.page_size = 10
+            count = registry.list(query, page_callback=pages.append).get()
+
+        self.assertEqual([10, 10, len(self.server.facilities) - 21],
+                         [len(page) for page in pages])
+        self.assertEqual(sum(len(page) for page in pages), count)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_save_and_delete_many(self):
+        facilities = [self.registry.create(name=random_string(),
+                                           coordinates=[1.0, 2.0])
+                      for i in range(6)]
+        invalid = self.registry.create(name=random_string(), coordinates=None)
+
+        progress = []
+        result = self.registry.save_many(facilities + [invalid], max_workers=3,
+                                         progress=progress.append)
+
+        self.assertEqual(7, len(progress))
+        self.assertEqual(6, len(result.succeeded))
+        self.assertEqual([invalid], [f for f, e in result.failed])
+        self.assertTrue(all(f['uuid'] and not f.is_modified
+                            for f in facilities))
+
+        missing = self.registry.Facility(new=False, uuid='missing')
+        result = self.registry.delete_many(facilities + [missing])
+
+        self.assertEqual(6, len(result.succeeded))
+        facility, error = result.failed[0]
+        self.assertIsInstance(error, freddy.FredHttpError)
+        self.assertEqual(404, error.fred_error_info['code'])
+        self.assertFalse(any(f['uuid'] in self.server.facilities
+                             for f in facilities))
+
+    def test_save_many_collects_other_errors(self):
+        facilities = [self.registry.create(name=random_string(),
+                                           coordinates=[1.0, 2.0])
+                      for i in range(4)]
+        bad = facilities[1]
+
+        create = self.registry.api.create
+        def create_or_fail(data):
+            if data['name'] == bad['name']:
+                raise ValueError("No JSON object could be decoded")
+            return create(data)
+        self.registry.api.create = create_or_fail
+
+        result = self.registry.save_many(facilities, max_workers=2)
+        self._created_facility_uuids.extend(
+            f['uuid'] for f in result.succeeded)
+
+        self.assertEqual(3, len(result.succeeded))
+        [(facility, error)] = result.failed
+        self.assertIs(bad, facility)
+        self.assertIsInstance(error, ValueError)
+
+    def test_partial_update(self):
+        self.registry.partial_updates = True
+
+        facility = self._create_facility()
+        del self.server.requests[:]
+
+        facility.save()
+        self.assertEqual([], self.server.requests)
+
+        facility['name'] = random_string()
+        facility['properties']['beds'] = 12
+        facility.save()
+
+        self.assertEqual({'name': facility['name'],
+                          'properties': {'beds': 12}}, self.server.last_body)
+        self.assertEqual(12, self.registry.get(
+            facility['uuid'])['properties']['beds'])
+
+    def test_partial_update_deleted_property(self):
+        self.registry.partial_updates = True
+
+        facility = self._create_facility()
+        facility['properties']['beds'] = 12
+        facility.save()
+
+        del facility['properties']['beds']
+        facility.save()
+
+        self.assertEqual({'properties': {}}, self.server.last_body)
+        self.assertNotIn('beds', self.registry.get(
+            facility['uuid'])['properties'])
+
+    def test_partial_update_existing_properties(self):
+        self.registry.partial_updates = True
+
+        facility = self.registry.get('facility-05')
+        facility['properties']['type'] = 'CHC'
+        facility.save()
+
+        self.assertEqual({'properties': {'beds': 5, 'type': 'CHC'}},
+                         self.server.last_body)
+        self.assertEqual({'beds': 5, 'type': 'CHC'},
+                         self.server.facilities['facility-05']['properties'])
+        self.assertEqual(5, facility['properties']['beds'])
+
+        del facility['properties']['type']
+        facility.save()
+        self.assertEqual({'beds': 5},
+                         self.server.facilities['facility-05']['properties'])
+
+    def test_lists_only_copied_when_needed(self):
+        self.assertIsNone(self.registry.get('facility-03')._snapshot)
+        self.assertIsNotNone(self.registry.session().get(
+            'facility-03')._snapshot)
+
+        self.registry.partial_updates = True
+        self.assertIsNotNone(self.registry.get('facility-03')._snapshot)
+
+    def test_partial_update_lists_changed_in_place(self):
+        self.registry.partial_updates = True
+
+        facility = self._create_facility()
+        facility['coordinates'][0] = 99.0
+        facility.save()
+
+        self.assertEqual({'coordinates': [99.0, -23.20]},
+                         self.server.last_body)
+        self.assertEqual(99.0, self.registry.get(
+            facility['uuid'])['coordinates'][0])
+
+        del self.server.requests[:]
+        facility.save()
+        self.assertEqual([], self.server.requests)
+
+    def test_cache(self):
+        cache = freddy.cache.FacilityCache(ttl=60)
+        self.registry.cache = cache
+        uuid = self.existing_facility['uuid']
+
+        facility = self.registry.get(uuid)
+        facility['identifiers'].append({'agency': 'a', 'context': 'b',
+                                        'id': 'c'})
+        same_facility = self.registry.get(uuid)
+
+        self.assertEqual(1, len(self.server.requests))
+        self.assertNotEqual(facility['identifiers'],
+                            same_facility['identifiers'])
+
+        cache.ttl = 0
+        self.registry.get(uuid)
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual({'hits': 1, 'misses': 1, 'revalidations': 1},
+                         cache.stats)
+
+        same_facility.save()
+        self.registry.get(uuid)
+        self.assertEqual(2, cache.misses)
+
+    def test_cache_read_during_save(self):
+        self.registry.cache = freddy.cache.FacilityCache(ttl=60)
+        facility = self.registry.get('facility-08')
+        old_name = facility['name']
+
+        # a get() while the update is in flight caches the old data
+        update = self.registry.api.update
+        def update_after_get(uuid, data):
+            self.registry.get(uuid)
+            return update(uuid, data)
+        self.registry.api.update = update_after_get
+
+        facility['name'] = random_string()
+        facility.save()
+        del self.registry.api.update
+
+        self.assertEqual(facility['name'],
+                         self.registry.get('facility-08')['name'])
+
+        facility['name'] = old_name
+        facility.save()
+
+    def test_cache_get_overtaken_by_save(self):
+        cache = freddy.cache.FacilityCache(ttl=60)
+        self.registry.cache = cache
+        facility = self.registry.get('facility-08')
+        old_name = facility['name']
+        cache.invalidate('facility-08')
+
+        # the server answers a get() before a save, which finishes before
+        # the get() stores the old data
+        get_if_modified = self.registry.api.get_if_modified
+        def get_then_save(id, **kwargs):
+            result = get_if_modified(id, **kwargs)
+            facility.save()
+            return result
+        self.registry.api.get_if_modified = get_then_save
+
+        facility['name'] = random_string()
+        self.registry.get('facility-08')
+        del self.registry.api.get_if_modified
+
+        self.assertIsNone(cache.backend.get('facility-08'))
+        self.assertEqual(facility['name'],
+                         self.registry.get('facility-08')['name'])
+
+        facility['name'] = old_name
+        facility.save()
+
+    def test_dirty(self):
+        loaded = list(self.registry.facilities.range(0, 3))
+        created = self.registry.create(name=random_string(),
+                                       coordinates=[1.0, 2.0])
+        self.assertEqual([created], self.registry.dirty())
+
+        loaded[0]['properties']['beds'] = 100
+        loaded[1]['name'] = loaded[1]['name']
+        self.assertEqual(set([created, loaded[0]]),
+                         set(self.registry.dirty()))
+
+        created.save()
+        self._created_facility_uuids.append(created['uuid'])
+        self.assertEqual([loaded[0]], self.registry.dirty())
+
+        created['name'] = random_string()
+        del loaded
+        gc.collect()
+        self.assertEqual([created], self.registry.dirty())
+
+    def test_dirty_nested_delete(self):
+        facility = self.registry.get('facility-03')
+        self.assertFalse(facility.is_modified)
+
+        del facility['properties']['beds']
+        self.assertTrue(facility.is_modified)
+        self.assertEqual([facility], self.registry.dirty())
+
+    def test_dirty_undone(self):
+        facility = self.registry.get('facility-03')
+
+        facility['properties']['x'] = 1
+        self.assertEqual([facility], self.registry.dirty())
+
+        del facility['properties']['x']
+        self.assertFalse(facility['properties'].is_modified)
+        self.assertFalse(facility.is_modified)
+        self.assertEqual([], self.registry.dirty())
+
+    def test_session(self):
+        with self.registry.session() as session:
+            facilities = list(session.facilities.range(0, 4))
+            self.assertIs(facilities[0], session.get(facilities[0]['uuid']))
+
+            facilities[0]['properties']['beds'] = 100
+            session.save(facilities[0])
+            facilities[0]['properties']['beds'] = 101
+            session.save(facilities[0])
+
+            facilities[1]['name'] = facilities[1]['name']
+
+            created = session.create(name=random_string(),
+                                     coordinates=[1.0, 2.0])
+            doomed = session.get(self._create_facility()['uuid'])
+            doomed.delete()
+
+            del self.server.requests[:]
+
+        self._created_facility_uuids.append(created['uuid'])
+        self._created_facility_uuids.remove(doomed['uuid'])
+
+        result = session.result
+        self.assertEqual(set([facilities[0], created]),
+                         set(result.saved.succeeded))
+        self.assertEqual([doomed], result.deleted.succeeded)
+        self.assertEqual(3, result.unchanged)
+        self.assertEqual(['DELETE', 'POST', 'PUT'],
+                         sorted(m for m, _, _ in self.server.requests))
+        self.assertEqual('DELETE', self.server.requests[-1][0])
+        self.assertEqual(101, self.registry.get(
+            facilities[0]['uuid'])['properties']['beds'])
+        self.assertEqual(([], []), session.pending)
+
+    def test_session_save_other_instance(self):
+        session = self.registry.session()
+        tracked = session.get('facility-04')
+
+        other = self.registry.get('facility-04')
+        other['name'] = random_string()
+        self.assertIs(other, session.save(other))
+        self.assertEqual(([other], []), session.pending)
+
+        del self.server.requests[:]
+        result = session.commit()
+
+        self.assertEqual([other], result.saved.succeeded)
+        self.assertEqual(['PUT'], [m for m, _, _ in self.server.requests])
+        self.assertEqual(other['name'],
+                         self.registry.get('facility-04')['name'])
+        self.assertIs(other, session.get('facility-04'))
+        self.assertIsNot(tracked, session.get('facility-04'))
+
+        session.save(tracked)
+        session.commit()
+
+    def test_session_facility_methods(self):
+        session = self.registry.session()
+        facility = session.get('facility-05')
+        old_name = facility['name']
+
+        # however many times the facility is saved, it's written once
+        for i in range(3):
+            facility['name'] = random_string()
+            facility.save()
+        created = session.create(name=random_string(), coordinates=[1.0, 2.0])
+        created.delete()
+
+        self.assertEqual(['GET'], [m for m, _, _ in self.server.requests])
+        self.assertEqual(([facility], []), session.pending)
+
+        session.commit()
+        self.assertEqual(['GET', 'PUT'],
+                         [m for m, _, _ in self.server.requests])
+        self.assertEqual(facility['name'],
+                         self.server.facilities['facility-05']['name'])
+
+        # once the session stops tracking it, the facility writes itself
+        session.rollback()
+        facility['name'] = old_name
+        facility.save()
+        self.assertEqual(['GET', 'PUT', 'PUT'],
+                         [m for m, _, _ in self.server.requests])
+
+    def test_session_changes_in_place(self):
+        uuids = [self._create_facility()['uuid'] for i in range(3)]
+        identifier = {'agency': 'a', 'context': 'b', 'id': 'c'}
+
+        with self.registry.session() as session:
+            changed, saved, untouched = [session.get(uuid) for uuid in uuids]
+            changed['identifiers'].append(identifier)
+            session.save(saved)
+            del self.server.requests[:]
+
+        self.assertEqual(set([changed, saved]),
+                         set(session.result.saved.succeeded))
+        self.assertEqual(1, session.result.unchanged)
+        self.assertEqual(['PUT', 'PUT'],
+                         [m for m, _, _ in self.server.requests])
+        self.assertEqual([identifier],
+                         self.registry.get(uuids[0])['identifiers'])
+        self.assertEqual(([], []), session.pending)
+
+    def test_session_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.registry.session() as session:
+                session.create(name=random_string(), coordinates=[1.0, 2.0])
+                raise ValueError()
+
+        self.assertEqual(([], []), session.pending)
+        self.assertEqual([], self.server.requests)
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('snapshot.json', 'snapshot.json.gz'):
+                path = os.path.join(directory, name)
+                self.registry.page_size = 10
+                count = self.registry.export_snapshot(path)
+
+                self.assertEqual(len(self.server.facilities), count)
+
+                with freddy.Snapshot(path, registry=self.registry) as snapshot:
+                    self.assertEqual(count, len(snapshot))
+                    self.assertEqual(
+                        3, snapshot.get('facility-03')['properties']['beds'])
+                    self.assertIsNone(snapshot.get('missing'))
+
+                    busy = snapshot.iter_facilities(
+                        lambda data: data['properties'].get('beds') in (5, 7))
+                    self.assertEqual(['facility-05', 'facility-07'],
+                                     sorted(f['uuid'] for f in busy))
+                    self.assertEqual(
+                        ['facility-02', 'facility-01'],
+                        [f['uuid'] for f in snapshot.iter_facilities(
+                            uuids=['facility-02', 'missing', 'facility-01'],
+                            readonly=True)])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_snapshot_query(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'snapshot.json')
+            query = self.registry.facilities.filter(active=False)
+            self.assertEqual(1, self.registry.export_snapshot(path, query))
+            self.assertFalse(query.raw_results)
+            self.assertIsInstance(next(iter(query)), freddy.Facility)
+
+            def query_function(params, **kwargs):
+                yield {'uuid': 'facility-01'}
+                raise freddy.FredError("page failed")
+
+            with self.assertRaises(freddy.FredError):
+                self.registry.export_snapshot(
+                    path, freddy.FacilityQuery(query_function))
+            self.assertEqual(['snapshot.json'], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_reconcile(self):
+        agency = random_string()
+
+        def facility(id, **kwargs):
+            data = {'name': id, 'coordinates': [1.0, 2.0],
+                    'identifiers': [{'agency': agency, 'context': 'code',
+                                     'id': id}],
+                    'properties': {'beds': 1}}
+            data.update(kwargs)
+            return data
+
+        for id in ('same', 'changed', 'gone'):
+            created = self.registry.create(facility(id))
+            created.save()
+            self._created_facility_uuids.append(created['uuid'])
+
+        records = [facility('same', properties={}),
+                   facility('changed', name='renamed',
+                            properties={'beds': 2}),
+                   facility('new')]
+
+        reconciler = freddy.reconcile.Reconciler(
+            self.registry, key=freddy.reconcile.by_identifier(agency, 'code'),
+            page_size=10)
+        reconciliation = reconciler.diff(records)
+
+        self.assertEqual(['new'], [r['name'] for r in reconciliation.create])
+        self.assertEqual(['gone'], [f['name'] for f in reconciliation.delete])
+        self.assertEqual(1, len(reconciliation.unchanged))
+        data, record, changes = reconciliation.update[0]
+        self.assertEqual({'name': ('changed', 'renamed'),
+                          'properties.beds': (1, 2)}, changes)
+
+        result = reconciler.apply(reconciliation, delete=True)
+        self.assertEqual([], result.failed)
+
+        uuids = [f['uuid'] for f in result.saved.succeeded]
+        self._created_facility_uuids.extend(
+            uuid for uuid in uuids if uuid not in self._created_facility_uuids)
+        self._created_facility_uuids.remove(
+            result.deleted.succeeded[0]['uuid'])
+
+        query = self.registry.facilities
+        reconciliation = reconciler.diff(records, query)
+        self.assertEqual(([], [], []), (reconciliation.create,
+                                        reconciliation.update,
+                                        reconciliation.delete))
+        self.assertEqual(3, len(reconciliation.unchanged))
+        self.assertFalse(query.raw_results)
+        self.assertFalse(query.prefetch_pages)
+
+    def test_fingerprints_skip_unchanged_saves(self):
+        store = freddy.fingerprint.FingerprintStore()
+        self.registry.fingerprints = store
+
+        facility = self.registry.get('facility-06')
+        beds = facility['properties']['beds']
+        facility['properties']['beds'] = beds + 1
+        facility['properties']['beds'] = beds
+        facility.save()
+
+        # a copy built elsewhere, with identifiers in a different order
+        data = facility.to_dict()
+        self.assertEqual(2, len(data['identifiers']))
+        data['identifiers'] = list(reversed(data['identifiers']))
+        self.registry.Facility(new=False, **data).save()
+
+        self.assertEqual(['GET'], [m for m, _, _ in self.server.requests])
+        self.assertEqual(2, store.skipped)
+
+        listed = [f for f in self.registry.facilities.range(0, 12)
+                  if f['uuid'] == 'facility-07']
+        listed[0]['name'] = 'renamed'
+        listed[0]['name'] = self.server.facilities['facility-07']['name']
+        listed[0].save()
+
+        facility['coordinates'] = [0.6, -0.6]
+        facility.save()
+        self.assertEqual(['GET', 'GET', 'PUT'],
+                         [m for m, _, _ in self.server.requests])
+        self.assertEqual(3, store.skipped)
+
+    def test_fingerprints_only_from_server(self):
+        store = freddy.fingerprint.FingerprintStore()
+        self.registry.fingerprints = store
+        self.registry.cache = freddy.cache.FacilityCache(ttl=60)
+        self.registry.query_cache = freddy.cache.QueryCache(ttl=60)
+
+        self.registry.get('facility-06')
+        list(self.registry.facilities.filter(active=False))
+        self.assertEqual(2, len(store.backend))
+
+        # cached data may be out of date, so isn't remembered
+        store.backend.clear()
+        self.registry.get('facility-06')
+        list(self.registry.facilities.filter(active=False))
+        self.assertEqual(0, len(store.backend))
+        self.assertEqual(2, len(self.server.requests))
+
+        self.registry.cache.ttl = 0
+        self.registry.get('facility-06')
+        self.assertIsNotNone(store.backend.get('facility-06'))
+
+    def test_retries_overloaded_requests(self):
+        controller = self.registry.api.controller
+        self.server.failures.extend([(503, {'Retry-After': '0'}),
+                                     (429, {'Retry-After': '0'})])
+
+        self.assertEqual('facility-01',
+                         self.registry.get('facility-01')['uuid'])
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(2, controller.retries)
+        self.assertLess(controller.limit, controller.max_concurrency)
+
+        # creating a facility isn't idempotent
+        self.server.failures.append((503, {'Retry-After': '0'}))
+        facility = self.registry.create(name=random_string(),
+                                        coordinates=[1.0, 2.0])
+        with self.assertRaises(freddy.FredHttpError):
+            facility.save()
+        self.assertEqual(4, len(self.server.requests))
+
+        controller.max_retries = 1
+        controller.backoff = 0
+        self.server.failures.extend([(502, {}), (502, {})])
+        with self.assertRaises(freddy.FredHttpError):
+            self.registry.get('facility-01')
+        self.assertEqual(6, len(self.server.requests))
+
+    def test_query_cache(self):
+        cache = freddy.cache.QueryCache(ttl=60)
+        self.registry.query_cache = cache
+        self.registry.page_size = None
+
+        def query(active):
+            return list(self.registry.facilities.filter(active=active))
+
+        active = query(True)
+        active[0]['properties']['beds'] = 100
+        self.assertNotEqual(100, query(True)[0]['properties'].get('beds'))
+        self.assertEqual(1, len(query(False)))
+        query(False)
+
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual({'hits': 2, 'misses': 2, 'invalidations': 0,
+                          'queries': 2, 'facilities': len(active) + 1},
+                         cache.stats)
+
+        # saving an active facility can't change the inactive results
+        self.registry.get('facility-04').save()
+        query(False)
+        self.assertEqual(2, cache.misses)
+        query(True)
+        self.assertEqual(3, cache.misses)
+
+        self._create_facility()
+        self.assertEqual(len(active) + 1, len(query(True)))
+        self.assertEqual(4, cache.misses)
+        self.assertEqual(2, cache.invalidations)
+
+    def test_query_cache_streams_results(self):
+        cache = freddy.cache.QueryCache(max_facilities=3)
+        read = []
+
+        def query(params):
+            for i in range(int(params['limit'])):
+                read.append(i)
+                yield {'uuid': str(i)}
+
+        results = cache.get({'limit': 5}, query)
+        self.assertEqual('0', next(results)['uuid'])
+        self.assertEqual([0], read)
+        self.assertEqual(5, len(list(results)) + 1)
+        self.assertEqual(0, len(cache))
+
+        self.assertEqual(3, len(list(cache.get({'limit': 3}, query))))
+        self.assertEqual(3, len(list(cache.get({'limit': 3}, query))))
+        self.assertEqual(1, cache.hits)
+
+    def test_query_cache_get_overtaken_by_save(self):
+        cache = freddy.cache.QueryCache(ttl=60)
+        self.registry.query_cache = cache
+        facility = self.registry.get('facility-08')
+
+        # the results are read from the server before a save finishes, and
+        # only stored once they've all been read
+        results = iter(self.registry.facilities.filter(active=True))
+        next(results)
+        old_name = facility['name']
+        facility['name'] = random_string()
+        facility.save()
+        list(results)
+
+        self.assertEqual(0, len(cache))
+        self.assertIn(facility['name'], [
+            f['name'] for f in self.registry.facilities.filter(active=True)])
+
+        facility['name'] = old_name
+        facility.save()
+
+    def test_delta_sync(self):
+        synced = []
+        sync = freddy.sync.DeltaSync(self.registry, synced.append, page_size=4)
+
+        self.assertEqual(len(self.server.facilities), sync.run())
+        self.assertEqual(len(self.server.facilities),
+                         len(set(f['uuid'] for f in synced)))
+
+        facility = self._create_facility()
+        del synced[:]
+        sync.run()
+
+        self.assertIn(facility['uuid'], [f['uuid'] for f in synced])
+        self.assertLess(len(synced), len(self.server.facilities))
+        self.assertEqual(facility['updatedAt'], sync.high_water_mark)
+
+    def test_delta_sync_resumes(self):
+        checkpoint = freddy.sync.MemoryCheckpoint()
+        synced = []
+
+        def handler(facility):
+            if len(synced) == 10:
+                raise ValueError()
+            synced.append(facility['uuid'])
+
+        sync = freddy.sync.DeltaSync(self.registry, handler, checkpoint,
+                                     page_size=4)
+        with self.assertRaises(ValueError):
+            sync.run()
+
+        sync.handler = lambda f: synced.append(f['uuid'])
+        sync.run()
+
+        self.assertEqual(len(self.server.facilities) + 2, len(synced))
+        self.assertEqual(len(self.server.facilities), len(set(synced)))
+
+    @staticmethod
+    def _tied_registry(facilities, calls, swap_ties=False):
+        """
+        A registry listing `facilities` sorted by updatedAt, recording the
+        params of each list request in `calls`.  With swap_ties, pairs of
+        facilities with the same timestamp swap places on every other
+        request.
+
+        """
+        def query_function(params, **kwargs):
+            calls.append(params)
+            results = facilities
+            if 'updatedSince' in params:
+                since = parse(params['updatedSince'])
+                results = [f for f in results if f['updatedAt'] >= since]
+
+            flip = len(calls) % 2 if swap_ties else 0
+            results = sorted(results, key=lambda f: (
+                f['updatedAt'], int(f['uuid']) ^ flip))
+
+            end = (None if params['limit'] == 'off' else
+                   params['offset'] + params['limit'])
+            return results[params['offset']:end]
+
+        class TiedRegistry(object):
+            @property
+            def facilities(self):
+                return freddy.FacilityQuery(query_function)
+
+        return TiedRegistry()
+
+    def test_delta_sync_unstable_tie_order(self):
+        same_time = datetime.datetime(2013, 1, 1, tzinfo=pytz.utc)
+        facilities = [{'uuid': str(i), 'updatedAt': same_time}
+                      for i in range(10)]
+        facilities += [{'uuid': str(i),
+                        'updatedAt': same_time + datetime.timedelta(days=i)}
+                       for i in range(10, 13)]
+
+        synced = []
+        sync = freddy.sync.DeltaSync(
+            self._tied_registry(facilities, [], swap_ties=True),
+            synced.append, page_size=3)
+
+        sync.run()
+        self.assertEqual(set(str(i) for i in range(13)),
+                         set(f['uuid'] for f in synced))
+        self.assertEqual(same_time + datetime.timedelta(days=12),
+                         sync.high_water_mark)
+
+    def test_delta_sync_large_tie_group(self):
+        same_time = datetime.datetime(2013, 1, 1, tzinfo=pytz.utc)
+        facilities = [{'uuid': str(i), 'updatedAt': same_time}
+                      for i in range(1000)]
+        calls = []
+
+        synced = []
+        checkpoint = freddy.sync.MemoryCheckpoint()
+        sync = freddy.sync.DeltaSync(self._tied_registry(facilities, calls),
+                                     synced.append, checkpoint, page_size=50)
+
+        self.assertEqual(1000, sync.run())
+        self.assertEqual(1000, len(set(f['uuid'] for f in synced)))
+
+        # each request re-reads at most one page of facilities already seen
+        self.assertEqual(21, len(calls))
+        self.assertEqual(2000, sum(min(p['limit'], 1000 - p['offset'])
+                                   for p in calls))
+        self.assertEqual(50, len(checkpoint.state['seen']))
+
+    def test_local_mirror(self):
+        mirror = freddy.mirror.LocalMirror()
+        freddy.sync.DeltaSync(self.registry, mirror.upsert).run()
+        self.assertEqual(len(self.server.facilities), len(mirror))
+
+        registry = freddy.Registry(self.url, backend=mirror)
+        del self.server.requests[:]
+
+        inactive = list(registry.facilities.filter(active=False))
+        self.assertEqual([self.inactive_facility_uuid],
+                         [f['uuid'] for f in inactive])
+
+        facilities = list(registry.facilities.filter(
+            updatedSince=self.updated_since_test_date).sort_asc('updatedAt'))
+        self.assertTrue(facilities)
+        self.assertTrue(all(f['updatedAt'] >= self.updated_since_test_date
+                            for f in facilities))
+        self.assertEqual(sorted(f['updatedAt'] for f in facilities),
+                         [f['updatedAt'] for f in facilities])
+
+        facilities = list(registry.facilities.filter(beds=12).select('name'))
+        self.assertEqual(['Facility 12'], [f['name'] for f in facilities])
+        self.assertEqual(None, facilities[0]['uuid'])
+
+        facilities = list(registry.facilities.sort_desc('beds').range(2, 5))
+        self.assertEqual([22, 21, 20],
+                         [f['properties']['beds'] for f in facilities])
+
+        facility = registry.get(self.existing_facility['uuid'])
+        self.assertEqual([], self.server.requests)
+
+        facility = registry.create(name=random_string(), coordinates=[1., 2.])
+        facility.save()
+        self.assertEqual(facility['name'],
+                         registry.get(facility['uuid'])['name'])
+
+        facility.delete()
+        self.assertNotIn(facility['uuid'], mirror)
+
+    def test_identifier_index(self):
+        index = self.registry.index_identifiers()
+        key = ('DHIS2', 'DHIS2_CODE', 'OU_222702')
+
+        self.assertEqual(self.existing_facility['uuid'], index.get(*key))
+        self.assertEqual(self.existing_facility['name'],
+                         index.get_facility(*key)['name'])
+        self.assertEqual(set([self.existing_facility['uuid']]),
+                         index.lookup(context='DHIS2_CODE'))
+        self.assertEqual(None, index.get('DHIS2', 'DHIS2_CODE', 'missing'))
+
+        facility = self._create_facility()
+        facility['identifiers'].append(
+            {'agency': 'DHIS2', 'context': 'DHIS2_UID', 'id': 'abc'})
+        facility.save()
+
+        self.assertEqual(set([self.existing_facility['uuid'],
+                              facility['uuid']]),
+                         index.lookup(agency='DHIS2'))
+
+        facility.delete()
+        self._created_facility_uuids = []
+        self.assertEqual(None, index.get('DHIS2', 'DHIS2_UID', 'abc'))
+
+        mirror = freddy.mirror.LocalMirror()
+        mirror.upsert_many(self.registry.facilities)
+        index = freddy.index.IdentifierIndex.from_mirror(mirror)
+        self.assertEqual(self.existing_facility['uuid'], index.get(*key))
+
+    def test_readonly_facilities(self):
+        facilities = list(self.registry.facilities.readonly())
+        facility = [f for f in facilities
+                    if f['uuid'] == self.existing_facility['uuid']][0]
+
+        self.assertIsInstance(facility, freddy.ReadOnlyFacility)
+        self.assertEqual(self.existing_facility['createdAt'],
+                         facility['createdAt'])
+        self.assertEqual('OU_222702',
+                         facility.get_identifiers('DHIS2')[0]['id'])
+        self.assertFalse(facility.is_modified)
+
+        with self.assertRaises(freddy.FredError):
+            facility['name'] = random_string()
+
+        editable = facility.edit()
+        self.assertEqual(facility.to_dict(), editable.to_dict())
+
+        changed = facility.edit()
+        changed['identifiers'].append({'agency': 'a', 'context': 'b',
+                                       'id': 'c'})
+        changed['coordinates'][0] = 0.0
+        changed['properties']['beds'] = 3
+        self.assertEqual(1, len(facility['identifiers']))
+        self.assertEqual(-11.5, facility['coordinates'][0])
+        self.assertNotIn('beds', facility['properties'])
+
+        editable['name'] = random_string()
+        editable.save()
+        self.assertEqual(editable['name'],
+                         self.registry.get(facility['uuid'])['name'])
+
+    column_fields = ('uuid', 'coordinates', 'active', 'updatedAt',
+                     'properties.beds')
+
+    @unittest.skipIf(freddy.columns.numpy is None, "requires NumPy")
+    def test_to_columns_numpy(self):
+        columns = self.registry.facilities.sort_desc('uuid').to_columns(
+            self.column_fields, use_numpy=True, end=3)
+
+        self.assertEqual(['facility-24', 'facility-23', 'facility-22'],
+                         list(columns['uuid']))
+        self.assertEqual((3, 2), columns['coordinates'].shape)
+        self.assertAlmostEqual(-2.3, columns['coordinates'][1, 1])
+        self.assertTrue(columns['active'].all())
+        self.assertEqual('2013-07-01T00:00:00.000',
+                         str(columns['updatedAt'][0]))
+        self.assertEqual([24, 23, 22], list(columns['properties.beds']))
+
+    def test_to_columns(self):
+        columns = self.registry.facilities.sort_desc('uuid').to_columns(
+            self.column_fields, use_numpy=False, end=3)
+
+        self.assertEqual(['facility-24', 'facility-23', 'facility-22'],
+                         columns['uuid'])
+        self.assertEqual(6, len(columns['coordinates']))
+        self.assertAlmostEqual(-2.3, columns['coordinates'][3])
+        self.assertEqual(parse("2013-07-01T00:00:00Z"), datetime.datetime(
+            1970, 1, 1, tzinfo=pytz.utc) + datetime.timedelta(
+                seconds=columns['updatedAt'][0]))
+
+    def test_spatial_index(self):
+        index = self.registry.index_coordinates()
+
+        nearest = index.nearest((1.03, -1.0), k=3)
+        self.assertEqual(['facility-10', 'facility-11', 'facility-09'],
+                         [uuid for uuid, km in nearest])
+        self.assertAlmostEqual(3.34, nearest[0][1], places=2)
+
+        self.assertEqual(set(['facility-09', 'facility-10', 'facility-11']),
+                         set(uuid for uuid, km in
+                             index.within_radius((1.0, -1.0), 16)))
+        self.assertEqual(set(['facility-01', 'facility-02']),
+                         set(index.within_bbox(0.05, -0.25, 0.25, 0.0)))
+
+        facility = self.registry.create(name=random_string(),
+                                        coordinates=[1.03, -1.0])
+        facility.save()
+        self.assertEqual(facility['uuid'],
+                         index.nearest((1.03, -1.0))[0][0])
+
+        facility.delete()
+        self.assertEqual('facility-10', index.nearest((1.03, -1.0))[0][0])
+
+    def test_save_partial_response_facility(self):
+        facility = next(iter(self.registry.facilities.select('uuid', 'name')))
+        self.assertIsNone(facility['coordinates'])
+        facility['name'] = facility['name']
+
+        with self.assertRaises(freddy.FredError):
+            facility.save()
+
+        self.registry.partial_updates = True
+        del self.server.requests[:]
+        facility.save()
+        self.assertEqual([], self.server.requests)
+
+        created = self._create_facility()
+        facility = [f for f in self.registry.facilities.select('uuid', 'name')
+                    if f['uuid'] == created['uuid']][0]
+        facility['name'] = random_string()
+        facility.save()
+
+        self.assertEqual({'name': facility['name']}, self.server.last_body)
+        self.assertEqual(created['coordinates'],
+                         self.registry.get(created['uuid'])['coordinates'])
+
+
+class TestPropertyDict(unittest.TestCase):
+    def test_parse_date(self):
+        for date in ("2012-02-17T14:54:39.987+0000", "2013-02-05T03:25:27Z",
+                     "2013-03-21T18:09:52", "2013-03-21T18:09:52.5-05:30",
+                     "2013-03-21"):
+            self.assertEqual(parse(date), freddy.util.parse_date(date))
+
+    def test_dates_parsed_on_access(self):
+        data = freddy.util.PropertyDict(
+            {'updatedAt': "2013-02-05T03:25:27Z", 'name': "foo"},
+            date_properties=('updatedAt',))
+
+        self.assertEqual(parse("2013-02-05T03:25:27Z"), data['updatedAt'])
+        self.assertEqual(dict(data.items()), {
+            'updatedAt': parse("2013-02-05T03:25:27Z"),
+            'name': "foo"
+        })
+
+        data['updatedAt'] = "2013-02-05T03:25:27+0000"
+        self.assertFalse(data.is_modified)
+
+    def test_nested_changes(self):
+        properties = freddy.util.PropertyDict({'beds': 2})
+        data = freddy.util.PropertyDict({'name': "foo",
+                                         'properties': properties})
+
+        properties['beds'] = 2
+        self.assertTrue(data.is_touched)
+        self.assertFalse(data.is_modified)
+
+        properties['beds'] = 3
+        self.assertTrue(data.is_modified)
+        self.assertEqual(({}, set()), data.get_changes())
+
+    def test_nested_changes_undone(self):
+        properties = freddy.util.PropertyDict({'beds': 2})
+        data = freddy.util.PropertyDict({'name': "foo",
+                                         'properties': properties})
+        changes = []
+        data.on_change = changes.append
+
+        properties['x'] = 1
+        self.assertTrue(data.is_modified)
+
+        del properties['x']
+        self.assertFalse(data.is_touched)
+        self.assertFalse(data.is_modified)
+        self.assertEqual([data, data], changes)
+
+
+class TestJSONCodec(unittest.TestCase):
+    def test_nested_dates(self):
+        date = datetime.datetime(2013, 2, 5, 3, 25, 27, tzinfo=pytz.utc)
+        data = {'updatedAt': date, 'properties': {'openedAt': date},
+                'identifiers': [{'id': date}]}
+
+        for codec in (freddy.util.get_default_codec(),
+                      freddy.util.JSONCodec()):
+            self.assertEqual({
+                'updatedAt': date.isoformat(),
+                'properties': {'openedAt': date.isoformat()},
+                'identifiers': [{'id': date.isoformat()}]
+            }, json.loads(codec.dumps(data)))
+
+
+class TestJSONArrayStream(unittest.TestCase):
+    def _chunked(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_chunk_boundaries(self):
+        facilities = [
+            {'uuid': u'1', 'name': u'Kamb\u00e0 \u6771\u4eac \U0001f3e5',
+             'coordinates': [-11.25, 8.5e-3], 'active': False,
+             'properties': {'beds': 12, 'nested': {'a': [1, {'b': None}]}}},
+            {'uuid': u'2', 'name': u'"quoted" \\ name', 'properties': {}},
+            123456789
+        ]
+        text = json.dumps({'before': {'facilities': [0]},
+                           'facilities': facilities,
+                           'after': [1.5, u'\u00e9']}, ensure_ascii=False)
+        text = text.encode('utf-8')
+
+        for size in range(1, len(text) + 1):
+            stream = freddy.util.JSONArrayStream(
+                self._chunked(text, size), 'facilities')
+            self.assertEqual(facilities, list(stream), size)
+
+    def test_empty(self):
+        for text in ('{}', '{"facilities": []}', ' { "facilities" : [ ] } '):
+            for size in (1, 2, len(text)):
+                self.assertEqual([], list(freddy.util.JSONArrayStream(
+                    self._chunked(text, size), 'facilities')))
+
+    def test_truncated(self):
+        text = '{"facilities": [{"uuid": "1"}, {"uuid": "2", "name": "a'
+        for size in (1, 7, len(text)):
+            stream = freddy.util.JSONArrayStream(
+                self._chunked(text, size), 'facilities')
+            with self.assertRaises(ValueError):
+                list(stream)
+
+        for text in ('{"facilities": [1, 2', '{"facilities": [1, 2]'):
+            stream = freddy.util.JSONArrayStream([text], 'facilities')
+            with self.assertRaises(ValueError):
+                list(stream)
+
+
+class TestFingerprint(unittest.TestCase):
+    def test_fingerprint(self):
+        data = {'uuid': '1', 'name': 'foo', 'coordinates': [1, 2],
+                'updatedAt': '2013-02-05T03:25:27Z',
+                'identifiers': [{'agency': 'a', 'context': 'b', 'id': 'c'},
+                                {'agency': 'a', 'context': 'b', 'id': 'd'}],
+                'properties': {'openedAt': '2013-02-05T03:25:27+00:00'}}
+        facility = freddy.Facility(new=False, **data)
+        facility['identifiers'].reverse()
+        facility['properties']['openedAt'] = parse('2013-02-05T03:25:27Z')
+
+        fingerprint = freddy.fingerprint.fingerprint
+        self.assertEqual(fingerprint(data), fingerprint(facility))
+
+        facility['properties']['beds'] = 1
+        self.assertNotEqual(fingerprint(data), fingerprint(facility))
+
+class TestRequestController(unittest.TestCase):
+    class Response(object):
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.headers = {}
+            self.elapsed = datetime.timedelta(seconds=0.01)
+
+        def close(self):
+            pass
+
+    def test_aimd(self):
+        controller = freddy.control.RequestController(
+            max_concurrency=8, max_retries=0)
+
+        controller.send('GET', '/facilities.json',
+                        lambda: self.Response(503))
+        self.assertEqual(4, controller.limit)
+
+        # only one decrease per round of requests
+        controller.send('GET', '/facilities.json',
+                        lambda: self.Response(503))
+        self.assertEqual(4, controller.limit)
+
+        for i in range(4):
+            controller.send('GET', '/facilities.json',
+                            lambda: self.Response(200))
+        self.assertAlmostEqual(5, controller.limit, places=0)
+
+    def test_concurrency_limit(self):
+        controller = freddy.control.RequestController(max_concurrency=2)
+        in_flight = []
+
+        def send():
+            in_flight.append(controller.in_flight)
+            time.sleep(0.01)
+            return self.Response(200)
+
+        threads = [threading.Thread(target=controller.send,
+                                    args=('GET', '/', send))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, max(in_flight))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_waiting_callers_get_copies(self):
+        flight = freddy.util.SingleFlight(copy_result=list)
+        release = threading.Event()
+
+        def fetch():
+            release.wait()
+            return [1, 2]
+
+        results = []
+        def follow():
+            results.append(flight.do('key', fetch))
+
+        leader = threading.Thread(target=follow)
+        leader.start()
+        while 'key' not in flight._calls:
+            time.sleep(0.001)
+
+        followers = [threading.Thread(target=follow) for i in range(3)]
+        for thread in followers:
+            thread.start()
+        while flight._calls['key'].waiters < 3:
+            time.sleep(0.001)
+
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual([False, True, True, True],
+                         sorted(shared for result, shared in results))
+        self.assertEqual(4, len(set(id(result) for result, _ in results)))
+        self.assertTrue(all(result == [1, 2] for result, _ in results))
+
+
+class TestDialects(unittest.TestCase):
+    def test_detected_from_url(self):
+        self.assertIsInstance(freddy.dialects.get_dialect(
+            TestResourceMapFacilityRegistry.url),
+            freddy.dialects.ResourceMapDialect)
+        self.assertIsInstance(freddy.dialects.get_dialect(
+            TestDHIS2FacilityRegistry.url), freddy.dialects.DHIS2Dialect)
+
+    def test_transform_functions(self):
+        url = TestResourceMapFacilityRegistry.url
+
+        self.assertEqual({'uuid': '1', 'name': 'foo'},
+                         freddy.transform_incoming_data(
+                             {'id': '1', 'name': 'foo'}, url))
+        self.assertEqual({'name': 'foo'}, freddy.transform_outgoing_data(
+            {'uuid': '1', 'name': 'foo'}, url))
+        self.assertIs(freddy._url_dialect(url), freddy._url_dialect(url))
+
+    def test_resource_map(self):
+        dialect = freddy.dialects.ResourceMapDialect()
+
+        self.assertEqual([{'uuid': '1', 'href': 'a', 'name': 'foo'}],
+                         dialect.incoming_page([{'id': '1', 'url': 'a',
+                                                 'name': 'foo'}]))
+        self.assertEqual({'name': 'foo'}, dialect.outgoing({
+            'uuid': '1', 'href': 'a', 'name': 'foo',
+            'createdAt': '2013-02-05T03:25:27Z'}))
+
+        # a subclass changing the fields gets the general conversions
+        class RenamedDialect(freddy.dialects.ResourceMapDialect):
+            FIELD_NAMES = {'uuid': 'key'}
+
+        self.assertEqual({'uuid': '1', 'url': 'a'},
+                         RenamedDialect().incoming({'key': '1', 'url': 'a'}))
+
+    def test_custom_dialect(self):
+        class NamedDialect(freddy.dialects.Dialect):
+            FIELD_NAMES = {'name': 'title'}
+            READ_ONLY_FIELDS = ('href',)
+
+        api = freddy.RegistryAPI('http://example.com', dialect=NamedDialect)
+
+        self.assertEqual({'uuid': '1', 'name': 'foo'},
+                         api.dialect.incoming({'uuid': '1', 'title': 'foo'}))
+        self.assertEqual({'uuid': '1', 'title': 'foo'},
+                         api.dialect.outgoing({'uuid': '1', 'name': 'foo',
+                                               'href': 'a'}))
+
+
 if __name__ == '__main__':
     # remove abstract parameterized testcase from scope so it doesn't get
     # tested
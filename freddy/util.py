@@ -1,14 +1,73 @@
+import calendar
+import codecs
 import datetime
+import email.utils
 import dateutil.parser
 import pytz
+import re
+import threading
 import types
 import json
 
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# The timestamp formats returned by DHIS2 and Resource Map, e.g.
+# 2012-02-17T14:54:39.987+0000 and 2013-02-05T03:25:27Z
+ISO_8601_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d+))?)?'
+    r'(Z|[+-]\d\d(?::?\d\d)?)?$')
+
+
+def parse_date(val):
+    """
+    Parse an ISO 8601 timestamp.  Handles the strict formats returned by
+    the API directly and falls back to dateutil for anything else.
+
+    """
+    match = ISO_8601_RE.match(val)
+    if match:
+        (year, month, day, hour, minute, second, fraction,
+         offset) = match.groups()
+        if offset is None:
+            tzinfo = None
+        elif offset == 'Z':
+            tzinfo = pytz.utc
+        else:
+            minutes = int(offset[1:3]) * 60 + int(offset[-2:] if
+                                                 len(offset) > 3 else 0)
+            if offset[0] == '-':
+                minutes = -minutes
+            tzinfo = pytz.FixedOffset(minutes) if minutes else pytz.utc
+
+        try:
+            return datetime.datetime(
+                int(year), int(month), int(day), int(hour), int(minute),
+                int(second or 0), int((fraction or '0')[:6].ljust(6, '0')),
+                tzinfo)
+        except ValueError:
+            pass
+
+    return dateutil.parser.parse(val)
+
 
 class ChangeTrackingDict(dict):
     """
     A dictionary that tracks what values are added, touched, modified, and
-    deleted after its initial creation.
+    deleted after its initial creation.  Changes to nested
+    ChangeTrackingDicts count as changes to the dictionary containing them.
+
+    If on_change is set to a function, it's called with the dictionary the
+    first time it's touched, the first time it's modified, and when deleting
+    added keys undoes its changes.
 
     """
     def __init__(self, *args, **kwargs):
@@ -21,42 +80,92 @@ class ChangeTrackingDict(dict):
 
         self.latest_values = {}
 
+        self.on_change = None
+        self._touched = False
+        self._modified = False
+
+        for val in dict.itervalues(self):
+            if isinstance(val, ChangeTrackingDict):
+                val.on_change = self._child_changed
+
     def __setitem__(self, name, val):
         try:
-            dict.__getitem__(self, name)
+            old_val = self[name]
         except KeyError:
-            self.added_keys.add(name)
+            # setting a deleted key again makes it a modification
+            if name in self.deleted_keys:
+                self.deleted_keys.remove(name)
+            else:
+                self.added_keys.add(name)
+            self.modified_keys.add(name)
+        else:
+            if old_val != val:
+                self.modified_keys.add(name)
 
         self.touched_keys.add(name)
 
-        if dict.__getitem__(self, name) != val:
-            self.modified_keys.add(name)
-
         dict.__setitem__(self, name, val)
 
+        if isinstance(val, ChangeTrackingDict):
+            val.on_change = self._child_changed
+
+        self._mark(True, name in self.modified_keys)
+
     def __delitem__(self, name):
-        if name in self.added_keys:
-            self.added_keys.remove(name)
-            self.touched_keys.remove(name)
-            self.modified_keys.remove(name)
-        else:
+        dict.__delitem__(self, name)
+
+        if name not in self.added_keys:
             self.deleted_keys.add(name)
             self.touched_keys.add(name)
             self.modified_keys.add(name)
+            self._mark(True, True)
+            return
 
-        dict.__delitem__(self, name)
+        self.added_keys.remove(name)
+        self.touched_keys.discard(name)
+        self.modified_keys.discard(name)
+
+        # removing an added key can undo the only change
+        self._recompute()
 
     @property
     def is_touched(self):
-        return (self.touched_keys or self.deleted_keys or
-                any(isinstance(v, ChangeTrackingDict) and v.is_touched
-                    for v in self.items()))
+        return self._touched
 
     @property
     def is_modified(self):
-        return (self.modified_keys or self.deleted_keys or
-                any(isinstance(v, ChangeTrackingDict) and v.is_modified
-                    for v in self.items()))
+        return self._modified
+
+    def _child_changed(self, child):
+        if child.is_modified:
+            self._mark(True, True)
+        else:
+            # the child's changes may have been undone
+            self._recompute()
+
+    def _recompute(self):
+        children = [v for v in dict.itervalues(self)
+                    if isinstance(v, ChangeTrackingDict)]
+        touched = bool(self.touched_keys or self.deleted_keys or
+                       any(v.is_touched for v in children))
+        modified = bool(self.modified_keys or self.deleted_keys or
+                        any(v.is_modified for v in children))
+
+        if (touched, modified) != (self._touched, self._modified):
+            self._touched = touched
+            self._modified = modified
+
+            if self.on_change is not None:
+                self.on_change(self)
+
+    def _mark(self, touched, modified):
+        if ((touched and not self._touched) or
+                (modified and not self._modified)):
+            self._touched = self._touched or touched
+            self._modified = self._modified or modified
+
+            if self.on_change is not None:
+                self.on_change(self)
 
     def get_changes(self, include_touched=False):
         """
@@ -70,36 +179,57 @@ class ChangeTrackingDict(dict):
         """
 
         keys = self.touched_keys if include_touched else self.modified_keys
-        return dict((k, self[k]) for k in keys), self.deleted_keys
+        return (dict((k, self[k]) for k in keys if k not in self.deleted_keys),
+                self.deleted_keys)
 
 
 class PropertyDict(ChangeTrackingDict):
     """
     A dictionary that only allows alphanumeric keys and automatically parses
-    dates when setting values for keys specified in the date_properties
-    argument.
+    dates for keys specified in the date_properties argument.  Dates passed
+    to the constructor are stored as given and only parsed when they're
+    first accessed.
 
     """
     def __init__(self, *args, **kwargs):
         self.date_properties = kwargs.pop('date_properties', {})
 
-        convert = lambda d: dict((k, self._parse_date(k, v))
-                                 for k, v in d.items())
-
-        if args:
-            args = (convert(args[0]),)
-        if kwargs:
-            kwargs = convert(kwargs)
-
         return super(PropertyDict, self).__init__(*args, **kwargs)
 
     def _parse_date(self, key, val):
         if (val is not None and key in self.date_properties and
             not isinstance(val, datetime.datetime)):
-            return dateutil.parser.parse(val)
+            return parse_date(val)
         else:
             return val
 
+    def __getitem__(self, name):
+        val = dict.__getitem__(self, name)
+
+        if isinstance(val, basestring) and name in self.date_properties:
+            val = parse_date(val)
+            dict.__setitem__(self, name, val)
+
+        return val
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self)
+
+    def itervalues(self):
+        return (self[k] for k in self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
     def __setitem__(self, name, val):
         if not(name.isalnum() and name[0].isalpha()):
             raise TypeError("Can't set non-alphanumeric property.")
@@ -108,6 +238,112 @@ class PropertyDict(ChangeTrackingDict):
         super(PropertyDict, self).__setitem__(name, val)
 
 
+class JSONArrayStream(object):
+    """
+    Incremental parser for a JSON object read as a sequence of UTF-8 encoded
+    chunks.  Yields the elements of the array stored under `key` one at a
+    time, as soon as each has been read, without decoding the whole document.
+    Other top-level values are decoded and discarded.
+
+    chunks -- an iterable of byte strings, e.g. Response.iter_content()
+    key -- the name of the top-level property holding the array
+    decoder -- optional object with a JSONDecoder-compatible raw_decode()
+
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, chunks, key, decoder=None):
+        self.chunks = iter(chunks)
+        self.key = key
+        if decoder is not None:
+            self.decoder = decoder
+
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    def __iter__(self):
+        self._expect(u'{')
+        if self._peek() == u'}':
+            return
+
+        while True:
+            key = self._value()
+            self._expect(u':')
+
+            if key == self.key:
+                self._expect(u'[')
+                if self._peek() != u']':
+                    while True:
+                        yield self._value()
+                        if self._peek() != u',':
+                            break
+                        self.pos += 1
+                self._expect(u']')
+            else:
+                self._value()
+
+            if self._peek() != u',':
+                break
+            self.pos += 1
+
+        self._expect(u'}')
+
+    def _fill(self):
+        """
+        Append the next chunk to the buffer, discarding what's already been
+        parsed.  Returns False if there's no more input.
+
+        """
+        if self.eof:
+            return False
+
+        try:
+            text = self.utf8.decode(next(self.chunks))
+        except StopIteration:
+            text = self.utf8.decode(b'', True)
+            self.eof = True
+
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = self.whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return u''
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Expected {0!r} at position {1} of {2!r}".format(
+                char, self.pos, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # incomplete value, unless we've run out of input
+                if not self._fill():
+                    raise
+                continue
+
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+
+            self.pos = end
+            return val
+
+
 def to_json(val):
     if isinstance(val, datetime.datetime):
         return val.isoformat()
@@ -116,7 +352,172 @@ def to_json(val):
 
 
 def to_json_string(data):
-    return json.dumps(dict((k, to_json(v)) for k, v in data.items()))
+    return JSONCodec().dumps(data)
+
+
+def encode_dates(val):
+    """
+    Returns a copy of `val` with datetimes converted to ISO 8601 strings at
+    any depth, for encoders that can't be given a default function.
+
+    """
+    if isinstance(val, datetime.datetime):
+        return val.isoformat()
+    elif isinstance(val, dict):
+        return dict((k, encode_dates(v)) for k, v in val.items())
+    elif isinstance(val, (list, tuple)):
+        return [encode_dates(v) for v in val]
+    else:
+        return val
+
+
+class JSONCodec(object):
+    """
+    Encodes request bodies and decodes responses using the standard library
+    json module.  Datetimes are encoded as ISO 8601 strings wherever they
+    appear, including inside extended properties and identifiers.
+
+    """
+    def dumps(self, data):
+        return json.dumps(data, default=self._default)
+
+    def loads(self, text):
+        return json.loads(text)
+
+    @property
+    def raw_decoder(self):
+        """Decoder used by JSONArrayStream to parse streamed responses."""
+
+        return json.JSONDecoder()
+
+    @staticmethod
+    def _default(val):
+        if isinstance(val, datetime.datetime):
+            return val.isoformat()
+        raise TypeError(repr(val) + " is not JSON serializable")
+
+
+class SimpleJSONCodec(JSONCodec):
+    """
+    Decodes using simplejson's C speedups, which are several times faster
+    than the standard library.  Encoding still uses the standard library,
+    which is at least as fast.
+
+    """
+    def loads(self, text):
+        return simplejson.loads(text)
+
+    @property
+    def raw_decoder(self):
+        return simplejson.JSONDecoder()
+
+
+class UJSONCodec(JSONCodec):
+    """
+    Decodes complete responses using ujson.  ujson can't encode datetimes or
+    decode incrementally, so encoding and streamed responses still use the
+    standard library.
+
+    """
+    def loads(self, text):
+        return ujson.loads(text)
+
+
+def get_default_codec():
+    """Returns the fastest JSON codec available."""
+
+    if simplejson is not None:
+        return SimpleJSONCodec()
+    elif ujson is not None:
+        return UJSONCodec()
+    else:
+        return JSONCodec()
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call at a time for each key.  Threads asking for a key
+    while a call for it is in progress wait for that call and share its
+    result (or exception) instead of making their own.
+
+    copy_result -- optional function used to give each waiting thread its
+        own copy of the result.  The copies are made before any thread gets
+        the result, so they can't race with changes made by another caller.
+
+    """
+    def __init__(self, copy_result=None):
+        self.copy_result = copy_result
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        Returns a tuple of func()'s result and whether it was shared with
+        another caller.
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.results.pop(), True
+
+        try:
+            result = func()
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            raise
+
+        # no more threads can join the call once it's been removed
+        with self._lock:
+            del self._calls[key]
+
+        try:
+            if self.copy_result is not None:
+                call.results = [self.copy_result(result)
+                                for i in range(call.waiters)]
+            else:
+                call.results = [result] * call.waiters
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            call.done.set()
+
+        return result, False
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = []
+        self.waiters = 0
+        self.error = None
+
+
+def to_http_date(val):
+    """
+    Format a datetime or ISO 8601 string as an HTTP date header value.
+    Naive datetimes are assumed to be in UTC.
+
+    """
+    if not isinstance(val, datetime.datetime):
+        val = parse_date(val)
+
+    return email.utils.formatdate(calendar.timegm(val.utctimetuple()),
+                                  usegmt=True)
 
 
 def to_urlparam(val):